@@ -0,0 +1,460 @@
+# benchmarks and a local stand-in for the upstream servers; kept out of scan-station.py so the booth install stays small
+import asyncio
+import os
+import json
+import collections
+import random
+import time
+import argparse
+import tempfile
+import contextlib
+import functools
+import importlib.util
+import pathlib
+import sys
+import aiohttp
+import aiohttp.web
+
+# scan-station.py isn't an importable module name, so load it from beside this file
+spec = importlib.util.spec_from_file_location("scan_station", pathlib.Path(__file__).with_name("scan-station.py"))
+station = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(station)
+
+@functools.lru_cache(maxsize=None)
+def fake_printer_class():
+    # built on first use, since subclassing Escpos means importing escpos
+    from escpos.escpos import Escpos
+
+    class FakePrinter(Escpos):
+        def __init__(self, latency=0.001, profile="TM-T88V", online=True):
+            Escpos.__init__(self, profile=profile)
+            self.latency = latency
+            self.online = online
+            self.writes = 0
+            self.bytes = 0
+
+        def _raw(self, msg):
+            self.writes += 1
+            self.bytes += len(msg)
+            if self.latency:
+                time.sleep(self.latency)
+
+        def is_online(self):
+            return self.online
+
+        def query_status(self, mode):
+            return []
+
+    return FakePrinter
+
+def fake_printer(**kwargs):
+    return fake_printer_class()(**kwargs)
+
+def bench_order(n_items):
+    items = [{"sku": f"SKU{i % 40:03d}", "size": "XL", "price": 25, "description": "DEF CON 32 t-shirt"} for i in range(n_items)]
+    order = {"i": [{"v": i, "q": 1} for i in range(n_items)], "txn": "A-1"}
+    return {"txn": "A-1", "total": 25*n_items, "count": n_items, "items": items, "qr": json.dumps(order)}
+
+def bench_receipt(args):
+    from PIL import Image
+    logo_dir = tempfile.mkdtemp()
+    Image.new("1", (384, 160)).save(os.path.join(logo_dir, "logo.png"))
+    assets = station.ReceiptAssets(os.path.join(logo_dir, "logo.png"), "TM-T88V", logo_dir)
+    print(f"{'items':>6} {'path':>8} {'writes':>7} {'bytes':>8} {'ms':>8}")
+    for n_items in (1, 5, 10):
+        order = bench_order(n_items)
+        for path in ("direct", "buffered"):
+            device = fake_printer(latency=args.latency/1000)
+            pm = station.PrinterManager(device=device, assets=assets)
+            start = time.perf_counter()
+            for _ in range(args.runs):
+                if path == "direct":
+                    pm.render_receipt(device, order)
+                else:
+                    pm.print_order(order)
+            elapsed = (time.perf_counter() - start) / args.runs
+            print(f"{n_items:>6} {path:>8} {device.writes//args.runs:>7} {device.bytes//args.runs:>8} {elapsed*1000:>8.2f}")
+
+def bench_ui(args):
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    ui = station.DisplayUI(asyncio.Queue(), [])
+    screens = [(ui.PRIMARY, ["Please scan your QR code"]),
+               (ui.SUCCESS, ["Thank you for your order", "Please take your receipt",
+                             "Turn in the long receipt", "Keep the short receipt"]),
+               (ui.PRIMARY, ["Please scan your QR code"]),
+               (ui.ERROR, ["Unable to validate order", "Are you being naughty?", "See a Goon to for help"])]
+    frames = args.runs * 50
+    print(f"{'renderer':>10} {'frames':>7} {'ms/frame':>9} {'cpu ms/frame':>13}")
+    for renderer in ("legacy", "cached"):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        for i in range(frames):
+            # a screen change every 25 frames, roughly one scan every 2.5 s at the old 10 fps tick
+            color, lines = screens[(i // 25) % len(screens)]
+            ui.set_screen(color, lines, timeout=None)
+            if renderer == "legacy":
+                if i % 25 == 0:
+                    ui.screen.fill(ui.background)
+                ui.screen.blit(ui.header, ui.header_rect)
+                for txt_surf, txt_rect in ui.render_text():
+                    ui.screen.blit(txt_surf, txt_rect)
+                station.pygame.display.update()
+            else:
+                ui.draw()
+        wall = (time.perf_counter() - wall) / frames
+        cpu = (time.process_time() - cpu) / frames
+        print(f"{renderer:>10} {frames:>7} {wall*1000:>9.3f} {cpu*1000:>13.3f}")
+    station.pygame.quit()
+
+def keystrokes(payload):
+    # a HID scanner presses shift for every shifted character, plus the final return
+    return sum(2 if c in station.CAPSCODES.values() and c not in station.SCANCODES.values() else 1 for c in payload) + 1
+
+def bench_payload(args):
+    import qrcode
+    print(f"{'items':>6} {'format':>8} {'bytes':>6} {'keys':>6} {'qr ver':>7} {'decode us':>10}")
+    for n_items in (1, 5, 20, 50):
+        order = {"i": [{"v": 1000 + i*37, "q": 1 + i % 3} for i in range(n_items)], "txn": ""}
+        for fmt in ("json", "compact"):
+            if fmt == "json":
+                payload = json.dumps(order, separators=(",", ":"))
+                decode = json.loads
+            else:
+                payload = station.encode_compact_order(order)
+                decode = station.decode_compact_order
+            assert decode(payload) == order
+            start = time.perf_counter()
+            for _ in range(args.runs * 100):
+                decode(payload)
+            elapsed = (time.perf_counter() - start) / (args.runs * 100)
+            code = qrcode.QRCode()
+            code.add_data(payload)
+            code.make(fit=True)
+            print(f"{n_items:>6} {fmt:>8} {len(payload):>6} {keystrokes(payload):>6} {code.version:>7} {elapsed*1000000:>10.2f}")
+
+class StandInServer:
+    # local replacement for the inventory feed and merch_addtxn.php with injectable faults
+    def __init__(self, items, latency=0, error_rate=0, outages=(), feed_stock=True):
+        self.items = items
+        # the real feed has no variant_stock_quantity; without it stock is only published on /stock
+        self.feed_stock = feed_stock
+        self.latency = latency
+        self.error_rate = error_rate
+        self.outages = outages
+        self.started = None
+        self.txns = set()
+        self.requests = collections.Counter()
+        self.stock = {item['variant_id']: item['variant_stock_quantity'] for item in items if 'variant_stock_quantity' in item}
+        self.stock_version = 0
+        self.stock_changes = dict.fromkeys(self.stock, 0)
+        self.stock_changed = asyncio.Condition()
+        self.oversold = 0
+
+    def unavailable(self):
+        elapsed = time.monotonic() - self.started
+        return any(start <= elapsed < end for start, end in self.outages)
+
+    async def fault(self, endpoint):
+        self.requests[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.unavailable():
+            self.requests[endpoint + " outage"] += 1
+            return aiohttp.web.Response(status=503)
+        if random.random() < self.error_rate:
+            self.requests[endpoint + " error"] += 1
+            return aiohttp.web.Response(status=500)
+        return None
+
+    async def inventory(self, request):
+        response = await self.fault("inventory")
+        if response is not None:
+            return response
+        etag = '"%d-%d"' % (len(self.items), self.stock_version)
+        if request.headers.get('If-None-Match') == etag:
+            return aiohttp.web.Response(status=304)
+        items = [dict(item, variant_stock_quantity=self.stock[item['variant_id']],
+                      variant_stock_status="IN" if self.stock[item['variant_id']] > 0 else "OUT")
+                 if item['variant_id'] in self.stock else item for item in self.items]
+        if not self.feed_stock:
+            items = [{k: v for k, v in item.items() if k != 'variant_stock_quantity'} for item in items]
+        return aiohttp.web.json_response(items, headers={"ETag": etag})
+
+    async def stock_updates(self, request):
+        response = await self.fault("stock")
+        if response is not None:
+            return response
+        since = int(request.query.get('since', -1))
+        async with self.stock_changed:
+            try:
+                await asyncio.wait_for(self.stock_changed.wait_for(lambda: self.stock_version > since),
+                                       float(request.query.get('wait', 30)))
+            except asyncio.TimeoutError:
+                pass
+        changes = [{"variant_id": id, "quantity": self.stock[id]} for id, version in self.stock_changes.items() if version > since]
+        return aiohttp.web.json_response({"cursor": self.stock_version, "changes": changes})
+
+    async def addtxn(self, request):
+        response = await self.fault("addtxn")
+        if response is not None:
+            return response
+        order = await request.json()
+        if order['txn_num'] in self.txns:
+            return aiohttp.web.json_response({"status": "duplicate"})
+        self.txns.add(order['txn_num'])
+        sold = [line for line in order['items'] if line['variant_id'] in self.stock]
+        if sold:
+            async with self.stock_changed:
+                self.stock_version += 1
+                for line in sold:
+                    id = line['variant_id']
+                    self.oversold += min(line['quantity'], max(0, line['quantity'] - self.stock[id]))
+                    self.stock[id] -= line['quantity']
+                    self.stock_changes[id] = self.stock_version
+                self.stock_changed.notify_all()
+        return aiohttp.web.json_response({"status": "ok"})
+
+    async def start(self, host="127.0.0.1", port=0):
+        app = aiohttp.web.Application()
+        app.router.add_get("/inventory", self.inventory)
+        app.router.add_post("/merch_addtxn.php", self.addtxn)
+        app.router.add_get("/stock", self.stock_updates)
+        self.runner = aiohttp.web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = aiohttp.web.TCPSite(self.runner, host, port)
+        await site.start()
+        self.started = time.monotonic()
+        host, port = self.runner.addresses[0][:2]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+def standin_items(n_variants, stock=0):
+    items = [{"variant_id": 1000 + i, "product_code": f"SKU{i:03d}", "product_title": "DEF CON 32 t-shirt",
+              "variant_code": "XL", "variant_price": 2500, "variant_stock_status": "IN",
+              "product_is_eligibility_restricted": "N"} for i in range(n_variants)]
+    if stock:
+        for item in items:
+            item['variant_stock_quantity'] = stock
+    return items
+
+async def run_standin(args):
+    station.journal.start()
+    server = StandInServer(standin_items(args.variants, args.stock), latency=args.upstream_latency/1000,
+                           error_rate=args.error_rate, outages=parse_outages(args.outage), feed_stock=not args.no_feed_stock)
+    url = await server.start(args.host, args.port)
+    print(f"inventory at {url}/inventory, orders at {url}/merch_addtxn.php, stock at {url}/stock")
+    await asyncio.Event().wait()
+
+KeyEvent = collections.namedtuple("KeyEvent", "type code value sec usec")
+
+def scan_events(payload, key_interval, start):
+    # what evdev reports for a HID scanner typing the payload: shift around shifted characters, then return
+    codes = {key: (code, False) for code, key in station.SCANCODES.items() if key and len(key) == 1}
+    for code, key in station.CAPSCODES.items():
+        if key and len(key) == 1 and key not in codes:
+            codes[key] = (code, True)
+    events = []
+    t = start
+    def key(code, value):
+        events.append(KeyEvent(station.ScanDecoder.EV_KEY, code, value, int(t), int(t % 1 * 1000000)))
+    for c in payload + "\n":
+        code, shift = codes[c] if c != "\n" else (station.ScanDecoder.RETURN, False)
+        if shift:
+            key(station.ScanDecoder.LEFT_SHIFT, 1)
+        key(code, 1)
+        key(code, 0)
+        if shift:
+            key(station.ScanDecoder.LEFT_SHIFT, 0)
+        t += key_interval
+    return events
+
+async def fake_scanner(name, payloads, interval, key_interval, chunk=16):
+    decoder = station.ScanDecoder(name, station.pipeline.submit)
+    station.scan_decoders.append(decoder)
+    for payload in payloads:
+        events = scan_events(payload, key_interval, time.time())
+        # evdev hands over whatever arrived since the last read, so feed the keys in small batches
+        for i in range(0, len(events), chunk):
+            await asyncio.sleep(key_interval * sum(1 for e in events[i:i+chunk] if e.value == 1 and e.code != station.ScanDecoder.LEFT_SHIFT))
+            decoder.feed(events[i:i+chunk])
+        await asyncio.sleep(interval)
+
+def parse_outages(specs):
+    outages = []
+    for spec in specs:
+        start, end = spec.split(":")
+        outages.append((float(start), float(end)))
+    return outages
+
+async def run_load(args):
+    # the station's components find each other through its module globals, as they do in main()
+    station.loop = loop = asyncio.get_running_loop()
+    workdir = tempfile.mkdtemp()
+    for k, v in {"DEVICE_ID": "bench", "CONFERENCE_ID": "bench", "PASSCODE": "bench", "STATION": "B"}.items():
+        os.environ.setdefault(k, v)
+    from PIL import Image
+    Image.new("1", (384, 160)).save(os.path.join(workdir, "logo.png"))
+    assets = station.ReceiptAssets(os.path.join(workdir, "logo.png"), "TM-T88V", workdir)
+
+    items = standin_items(args.variants, args.stock)
+    server = StandInServer(items, latency=args.upstream_latency/1000, error_rate=args.error_rate,
+                           outages=parse_outages(args.outage), feed_stock=not args.no_feed_stock)
+    url = await server.start()
+    hub = hub_url = None
+    if args.hub:
+        hub = station.Hub(station.OrderDB(os.path.join(workdir, "hub.db")), url + "/inventory", url + "/merch_addtxn.php",
+                  interval=args.inventory_interval)
+        hub_url = await hub.start("127.0.0.1", 0)
+
+    station.odb = odb = station.OrderDB(os.path.join(workdir, "orders.db"))
+    station.inventory = inventory = station.Inventory(url + "/inventory", interval=args.inventory_interval, hub_url=hub_url and hub_url + "/inventory")
+    loop.create_task(inventory.periodicly_update_inventory())
+    while inventory.updated is None:
+        await asyncio.sleep(0.05)
+    if args.stock:
+        loop.create_task(inventory.follow_stock(url + "/stock"))
+    spoolers = [station.PrintSpooler(station.PrinterManager({"lane": f"B-{i+1}"}, device=fake_printer(latency=args.latency/1000), assets=assets),
+                                     maxsize=args.print_queue)
+                for i in range(args.printers)]
+    station.dispatcher = dispatcher = station.PrintDispatcher(spoolers)
+    station.pipeline = pipeline = station.OrderPipeline(queue_size=args.pipeline_queue)
+    station.sync_worker = sync_worker = station.SyncWorker(url + "/merch_addtxn.php", base_delay=args.sync_base_delay,
+                                                           max_delay=args.sync_max_delay, hub_url=hub_url and hub_url + "/merch_addtxn.php")
+    loop.create_task(sync_worker.run())
+    dispatcher.start()
+    pipeline.start()
+
+    rng = random.Random(1)
+    payloads = []
+    for _ in range(args.orders):
+        order = {"i": [{"v": rng.choice(items)['variant_id'], "q": rng.randint(1, 3)} for _ in range(rng.randint(1, args.max_items))], "txn": ""}
+        payloads.append(station.encode_compact_order(order) if args.compact else json.dumps(order))
+    per_scanner = [payloads[i::args.scanners] for i in range(args.scanners)]
+
+    def accepted():
+        with station.metrics.lock:
+            return sum(v for k, v in station.metrics.counters.items() if k[0] == "orders_accepted_total")
+    def printed():
+        with station.metrics.lock:
+            return station.metrics.histograms.get(("order_stage_seconds", (("stage", "printed"),)), [0, 0])[-2]
+    backlog_peak = 0
+    async def sample_backlog():
+        nonlocal backlog_peak
+        while True:
+            backlog_peak = max(backlog_peak, odb.get_unsynced_order_count())
+            await asyncio.sleep(0.01)
+    sampler = loop.create_task(sample_backlog())
+
+    start = time.monotonic()
+    await asyncio.gather(*(fake_scanner(f"scanner{i}", p, args.interval/1000, args.key_interval/1000)
+                           for i, p in enumerate(per_scanner)))
+    scanned = time.monotonic()
+    while printed() < accepted() and time.monotonic() - scanned < args.timeout:
+        await asyncio.sleep(0.01)
+    all_printed = time.monotonic()
+    while (odb.get_unsynced_order_count() or (hub and hub.db.relay_backlog)) and time.monotonic() - scanned < args.timeout:
+        await asyncio.sleep(0.01)
+    drained = time.monotonic()
+    sampler.cancel()
+    if hub:
+        await hub.stop()
+    await server.stop()
+    return {"elapsed": all_printed - start, "drain": drained - scanned,
+            "backlog_peak": backlog_peak, "backlog_left": odb.get_unsynced_order_count(),
+            "accepted": accepted(), "printed": printed(), "synced": len(server.txns), "oversold": server.oversold,
+            "requests": server.requests, "stats": pipeline.stats()}
+
+def bench_load(args):
+    station.journal.start(echo=args.verbose)
+    with open(os.devnull, "w") as quiet, contextlib.redirect_stdout(sys.stdout if args.verbose else quiet):
+        result = asyncio.run(run_load(args))
+    stage = lambda q, name: (station.metrics.quantile("order_stage_seconds", q, {"stage": name}) or 0) * 1000
+    shed = sum(s['shed'] for s in result['stats'].values())
+    print(f"orders scanned:    {args.orders} on {args.scanners} scanners, {args.printers} printers")
+    print(f"accepted/printed:  {result['accepted']:.0f} / {result['printed']}, {shed} shed as busy")
+    print(f"throughput:        {result['accepted'] / result['elapsed'] * 60:.0f} orders/min")
+    print(f"scan to print:     p50 {stage(0.5, 'printed'):.1f}ms  p99 {stage(0.99, 'printed'):.1f}ms")
+    print(f"scan to persist:   p50 {stage(0.5, 'persisted'):.1f}ms  p99 {stage(0.99, 'persisted'):.1f}ms")
+    print(f"scan to sync:      p50 {stage(0.5, 'synced'):.1f}ms  p99 {stage(0.99, 'synced'):.1f}ms")
+    print(f"sync backlog:      peak {result['backlog_peak']}, drained {result['drain']:.2f}s after the last scan, {result['backlog_left']} left")
+    if args.stock:
+        print(f"stock:             {station.metrics.counters.get(('orders_rejected_total', (('reason', 'item out of stock'),)), 0):.0f} orders rejected as sold out, {result['oversold']} units oversold")
+    print(f"upstream:          {result['synced']} orders received, requests {dict(result['requests'])}")
+
+def bench_validate(args):
+    import tracemalloc
+    with open(os.devnull, "w") as quiet, contextlib.redirect_stdout(quiet):
+        station.odb = station.OrderDB(os.path.join(tempfile.mkdtemp(), "orders.db"))
+    station.inventory = inventory = station.Inventory(None)
+    carts = [(1, 1), (10, 1), (10, 5), (50, 1)]
+    print(f"{'catalog':>8} {'lines':>6} {'qty':>4} {'us/order':>9} {'peak KB':>8}")
+    for n_variants in (100, 10000, 100000):
+        inventory.inventory = {1000 + i: station.InventoryItem(1000 + i, f"SKU{i:06d}", "DEF CON 32 t-shirt", "XL", 2500, "IN", "N")
+                               for i in range(n_variants)}
+        for n_lines, quantity in carts:
+            order = {"i": [{"v": 1000 + i*7919 % n_variants, "q": quantity} for i in range(n_lines)], "txn": ""}
+            runs = max(1, args.runs * 1000 // n_lines)
+            start = time.perf_counter()
+            for _ in range(runs):
+                station.validate_order(order)
+            elapsed = (time.perf_counter() - start) / runs
+            tracemalloc.start()
+            station.validate_order(order)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"{n_variants:>8} {n_lines:>6} {quantity:>4} {elapsed*1000000:>9.2f} {peak/1024:>8.1f}")
+
+BENCHMARKS = {
+    "receipt": bench_receipt,
+    "ui": bench_ui,
+    "payload": bench_payload,
+    "load": bench_load,
+    "validate": bench_validate,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="merch scan station benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name in BENCHMARKS:
+        bench = commands.add_parser(name, help=f"run the {name} benchmark")
+        bench.add_argument("--runs", type=int, default=20)
+        bench.add_argument("--latency", type=float, default=1.0, help="simulated per-write device latency in ms")
+    load = commands.choices["load"]
+    load.add_argument("--orders", type=int, default=200)
+    load.add_argument("--scanners", type=int, default=2)
+    load.add_argument("--printers", type=int, default=1)
+    load.add_argument("--variants", type=int, default=40)
+    load.add_argument("--max-items", type=int, default=4)
+    load.add_argument("--stock", type=int, default=0, help="starting quantity per variant in the feed, 0 leaves stock untracked")
+    load.add_argument("--no-feed-stock", action="store_true", help="leave quantities out of the inventory feed, as upstream does, so stock only comes from /stock")
+    load.add_argument("--compact", action="store_true", help="scan compact M1 payloads instead of JSON")
+    load.add_argument("--interval", type=float, default=50, help="ms between scans on each scanner")
+    load.add_argument("--key-interval", type=float, default=1.0, help="ms between scanner keystrokes")
+    load.add_argument("--upstream-latency", type=float, default=20, help="ms added to every upstream request")
+    load.add_argument("--error-rate", type=float, default=0.0, help="fraction of upstream requests that fail with a 500")
+    load.add_argument("--outage", action="append", default=[], metavar="START:END",
+                      help="seconds after start during which upstream returns 503, may be repeated")
+    load.add_argument("--inventory-interval", type=float, default=5)
+    load.add_argument("--sync-base-delay", type=float, default=0.5)
+    load.add_argument("--sync-max-delay", type=float, default=5)
+    load.add_argument("--pipeline-queue", type=int, default=16)
+    load.add_argument("--print-queue", type=int, default=32)
+    load.add_argument("--timeout", type=float, default=120, help="give up waiting for the backlog to drain after this many seconds")
+    load.add_argument("--hub", action="store_true", help="route the station through an in-process booth hub")
+    load.add_argument("--verbose", action="store_true", help="show the station's own output")
+    standin = commands.add_parser("standin", help="serve a local stand-in for the inventory feed and merch_addtxn.php")
+    standin.add_argument("--host", default="127.0.0.1")
+    standin.add_argument("--port", type=int, default=8000)
+    standin.add_argument("--variants", type=int, default=40)
+    standin.add_argument("--stock", type=int, default=0)
+    standin.add_argument("--no-feed-stock", action="store_true", help="publish quantities only on /stock")
+    standin.add_argument("--upstream-latency", type=float, default=0, help="ms added to every request")
+    standin.add_argument("--error-rate", type=float, default=0.0)
+    standin.add_argument("--outage", action="append", default=[], metavar="START:END")
+    args = parser.parse_args()
+    if args.command == "standin":
+        asyncio.run(run_standin(args))
+    else:
+        BENCHMARKS[args.command](args)
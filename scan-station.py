@@ -1,138 +1,1168 @@
-import aiohttp.web_exceptions
-import pygame
 import asyncio
-import evdev
 import os
 import json
-from escpos import printer
+import hashlib
+import hmac
+import urllib.error
+import urllib.parse
+import urllib.request
+import collections
+import random
+import time
 import datetime
-import requests
-from requests.exceptions import HTTPError
 from dotenv import load_dotenv
 import sqlite3
+import argparse
+import contextlib
+import sys
+import queue
+import threading
+import concurrent.futures
+import multiprocessing
+import itertools
+import gzip
+import csv
+import pathlib
+import atexit
 import aiohttp
-from aiohttp.web_exceptions import HTTPError
+import aiohttp.web
 
 scanner_names = ["BF SCAN SCAN KEYBOARD"]
-q = asyncio.Queue()
 lock = asyncio.Lock()
+scan_decoders = []
+
+# DLE EOT 2, offline cause status; bit 2 is set while the cover is open
+RT_STATUS_OFFLINE = b"\x10\x04\x02"
+
+# each entry upgrades the orders database by one PRAGMA user_version step
+MIGRATIONS = [
+    [
+        "CREATE INDEX IF NOT EXISTS orders_synced ON orders (synced)",
+        "CREATE INDEX IF NOT EXISTS order_line_order_id ON order_line (order_id)",
+        "CREATE TABLE IF NOT EXISTS orders_archive (id INTEGER PRIMARY KEY, t TIMESTAMP, items INTEGER, total INTEGER, synced BOOLEAN)",
+        "CREATE TABLE IF NOT EXISTS order_line_archive (id INTEGER PRIMARY KEY, order_id INTEGER, item INTEGER, quantity INTEGER, pricelong INTEGER)",
+        "CREATE INDEX IF NOT EXISTS order_line_archive_order_id ON order_line_archive (order_id)",
+    ],
+    [
+        "CREATE TABLE IF NOT EXISTS print_jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, txn TEXT, payload TEXT, state TEXT DEFAULT 'queued', attempts INTEGER DEFAULT 0, error TEXT, created TIMESTAMP DEFAULT CURRENT_TIMESTAMP, updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP)",
+        "CREATE INDEX IF NOT EXISTS print_jobs_txn ON print_jobs (txn)",
+        "CREATE INDEX IF NOT EXISTS print_jobs_state ON print_jobs (state)",
+    ],
+    [
+        "CREATE TABLE IF NOT EXISTS inventory (variant_id INTEGER PRIMARY KEY, data TEXT)",
+        "CREATE TABLE IF NOT EXISTS inventory_meta (key TEXT PRIMARY KEY, value TEXT)",
+    ],
+    [
+        "ALTER TABLE orders ADD COLUMN txn TEXT",
+        "ALTER TABLE orders_archive ADD COLUMN txn TEXT",
+        "ALTER TABLE print_jobs ADD COLUMN lane TEXT",
+    ],
+    [
+        "ALTER TABLE orders ADD COLUMN cart_hash TEXT",
+        "CREATE INDEX IF NOT EXISTS orders_cart_hash ON orders (cart_hash, t)",
+    ],
+    [
+        "CREATE TABLE IF NOT EXISTS stock (variant_id INTEGER PRIMARY KEY, quantity INTEGER, sold INTEGER DEFAULT 0)",
+    ],
+    [
+        "CREATE TABLE IF NOT EXISTS relay (id INTEGER PRIMARY KEY AUTOINCREMENT, txn TEXT UNIQUE, body TEXT, received TIMESTAMP DEFAULT CURRENT_TIMESTAMP, forwarded BOOLEAN DEFAULT FALSE)",
+        "CREATE INDEX IF NOT EXISTS relay_forwarded ON relay (forwarded)",
+    ],
+    [
+        "CREATE INDEX IF NOT EXISTS orders_t ON orders (t)",
+        "CREATE INDEX IF NOT EXISTS orders_archive_t ON orders_archive (t)",
+    ],
+]
+
+JOURNAL_LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+JOURNAL_LEVEL_NAMES = {v: k for k, v in JOURNAL_LEVELS.items()}
+
+class Journal:
+    # structured event log; callers only append a tuple to a ring buffer, a writer thread
+    # formats, echoes and writes rotating JSONL files and gzips them as they fill
+    def __init__(self, ring_size=8192, flush_interval=0.25):
+        self.ring = collections.deque(maxlen=ring_size)
+        self.seq = itertools.count(1)
+        self.flush_interval = flush_interval
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.default_level = JOURNAL_LEVELS['info']
+        self.levels = {}
+        self.boot = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+        self.directory = None
+        self.file = None
+        self.echo = True
+        self.written = 0
+        self.dropped = 0
+
+    def configure(self, spec):
+        # "info,sync=debug,scanner=warning": a bare level is the default, name=level sets a subsystem
+        for part in filter(None, (p.strip() for p in (spec or "").split(","))):
+            name, _, level = part.rpartition("=")
+            if level not in JOURNAL_LEVELS:
+                raise ValueError(f"unknown journal level {level}")
+            if name:
+                self.levels[name] = JOURNAL_LEVELS[level]
+            else:
+                self.default_level = JOURNAL_LEVELS[level]
+
+    def enabled(self, sub, level):
+        return level >= self.levels.get(sub, self.default_level)
+
+    def emit(self, sub, level, event, txn=None, **fields):
+        if level < self.levels.get(sub, self.default_level):
+            return
+        self.ring.append((next(self.seq), time.time(), sub, level, event, txn, fields))
+        if level >= JOURNAL_LEVELS['error']:
+            self.wakeup.set()
+
+    def debug(self, sub, event, txn=None, **fields):
+        self.emit(sub, 10, event, txn, **fields)
+
+    def info(self, sub, event, txn=None, **fields):
+        self.emit(sub, 20, event, txn, **fields)
+
+    def warning(self, sub, event, txn=None, **fields):
+        self.emit(sub, 30, event, txn, **fields)
+
+    def error(self, sub, event, txn=None, **fields):
+        self.emit(sub, 40, event, txn, **fields)
+
+    def start(self, directory=None, echo=True, max_bytes=8*1024*1024, backups=20):
+        self.directory = directory
+        self.echo = echo
+        self.max_bytes = max_bytes
+        self.backups = backups
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self.file = open(os.path.join(directory, "journal.jsonl"), "a", encoding="utf-8")
+        threading.Thread(target=self.writer, name="journal", daemon=True).start()
+        atexit.register(self.flush)
+
+    def writer(self):
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as err:
+                sys.stderr.write(f"journal writer failed: {err}\n")
 
+    def flush(self):
+        with self.lock:
+            batch = []
+            try:
+                while True:
+                    batch.append(self.ring.popleft())
+            except IndexError:
+                pass
+            if not batch:
+                return
+            lines = []
+            echoed = []
+            for seq, t, sub, level, event, txn, fields in batch:
+                if seq != self.written + 1:
+                    # the ring overwrote records before the writer got to them
+                    self.dropped += seq - self.written - 1
+                self.written = seq
+                record = {"t": round(t, 6), "boot": self.boot, "seq": seq, "sub": sub,
+                          "level": JOURNAL_LEVEL_NAMES.get(level, level), "event": event}
+                if txn is not None:
+                    record['txn'] = txn
+                record.update(fields)
+                if self.file:
+                    lines.append(json.dumps(record, default=str))
+                if self.echo:
+                    echoed.append(self.format(record))
+            if echoed:
+                sys.stdout.write("\n".join(echoed) + "\n")
+                sys.stdout.flush()
+            if self.file:
+                self.file.write("\n".join(lines) + "\n")
+                self.file.flush()
+                if self.file.tell() >= self.max_bytes:
+                    self.rotate()
+
+    def format(self, record):
+        extra = " ".join(f"{k}={v}" for k, v in record.items() if k not in ("t", "boot", "seq", "sub", "level", "event", "txn"))
+        stamp = datetime.datetime.fromtimestamp(record['t']).strftime("%H:%M:%S.%f")[:-3]
+        return f"{stamp} {record['level']:<7} {record['sub']:<9} {record['event']}" + (f" {record['txn']}" if 'txn' in record else "") + (f" {extra}" if extra else "")
+
+    def rotate(self):
+        self.file.close()
+        current = os.path.join(self.directory, "journal.jsonl")
+        rotated = os.path.join(self.directory, f"journal-{datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')}.jsonl.gz")
+        with open(current, "rb") as src, gzip.open(rotated, "wb") as dst:
+            while True:
+                chunk = src.read(1 << 20)
+                if not chunk:
+                    break
+                dst.write(chunk)
+        self.file = open(current, "w", encoding="utf-8")
+        rotated = [f for f in journal_files(self.directory) if f.endswith(".gz")]
+        for old in rotated[:max(0, len(rotated) - self.backups)]:
+            os.remove(old)
+
+    def stats(self):
+        return {"buffered": len(self.ring), "written": self.written, "dropped": self.dropped}
+
+def journal_files(directory):
+    # rotated files sort by their timestamp, the live file always comes last
+    rotated = sorted(os.path.join(directory, f) for f in os.listdir(directory) if f.startswith("journal-") and f.endswith(".jsonl.gz"))
+    current = os.path.join(directory, "journal.jsonl")
+    return rotated + ([current] if os.path.exists(current) else [])
+
+def read_journal(directory):
+    for path in journal_files(directory):
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # a crash can leave a torn last line
+                    continue
+
+def replay(args):
+    # a txn's own records carry the scan id the pipeline gave it, which pulls in the events logged before it had a txn
+    records = list(read_journal(args.dir))
+    scans = {(r['boot'], r['scan']) for r in records if r.get('txn') == args.txn and 'scan' in r}
+    timeline = [r for r in records if r.get('txn') == args.txn or (r.get('boot'), r.get('scan')) in scans]
+    if not timeline:
+        print(f"no journal records for {args.txn} in {args.dir}")
+        return
+    timeline.sort(key=lambda r: r['t'])
+    start = timeline[0]['t']
+    for r in timeline:
+        print(f"{(r['t'] - start)*1000:>9.1f}ms  " + journal.format(r))
+
+journal = Journal()
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+class Metrics:
+    def __init__(self, max_traces=1024):
+        self.lock = threading.Lock()
+        self.help = {}
+        self.counters = collections.defaultdict(float)
+        self.histograms = {}
+        self.samples = {}
+        self.gauges = {}
+        self.traces = collections.OrderedDict()
+        self.max_traces = max_traces
+
+    def labels(self, labels):
+        return tuple(sorted(labels.items())) if labels else ()
+
+    def inc(self, name, labels=None, value=1):
+        with self.lock:
+            self.counters[(name, self.labels(labels))] += value
+
+    def observe(self, name, value, labels=None):
+        key = (name, self.labels(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0]*len(LATENCY_BUCKETS) + [0, 0.0]
+                self.samples[key] = collections.deque(maxlen=4096)
+            self.samples[key].append(value)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += 1
+            histogram[-1] += value
+
+    def quantile(self, name, q, labels=None):
+        # exact quantile over the most recent observations, the buckets are too coarse for benchmarks
+        with self.lock:
+            samples = sorted(self.samples.get((name, self.labels(labels)), ()))
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def gauge(self, name, fn, help=None):
+        # fn returns a list of (labels, value)
+        self.gauges[name] = fn
+        if help:
+            self.help[name] = help
+
+    def trace(self, txn, marks):
+        with self.lock:
+            self.traces[txn] = dict(marks)
+            while len(self.traces) > self.max_traces:
+                self.traces.popitem(last=False)
+        for stage, t in marks.items():
+            if stage != "scanned" and "scanned" in marks:
+                self.observe("order_stage_seconds", t - marks['scanned'], {"stage": stage})
+
+    def mark(self, txn, stage):
+        now = time.monotonic()
+        with self.lock:
+            marks = self.traces.get(txn)
+            if marks is None:
+                return
+            marks[stage] = now
+            if "printed" in marks and "synced" in marks:
+                del self.traces[txn]
+        if "scanned" in marks:
+            self.observe("order_stage_seconds", now - marks['scanned'], {"stage": stage})
+
+    def format_labels(self, labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+    def render(self):
+        out = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((k, list(v)) for k, v in self.histograms.items())
+        seen = set()
+        for (name, labels), value in counters:
+            if name not in seen:
+                seen.add(name)
+                out.append(f"# TYPE {name} counter")
+            out.append(f"{name}{self.format_labels(labels)} {value:g}")
+        for (name, labels), histogram in histograms:
+            if name not in seen:
+                seen.add(name)
+                out.append(f"# TYPE {name} histogram")
+            for bound, count in zip(LATENCY_BUCKETS, histogram):
+                out.append(f"{name}_bucket{self.format_labels(labels, (('le', bound),))} {count}")
+            out.append(f"{name}_bucket{self.format_labels(labels, (('le', '+Inf'),))} {histogram[-2]}")
+            out.append(f"{name}_count{self.format_labels(labels)} {histogram[-2]}")
+            out.append(f"{name}_sum{self.format_labels(labels)} {histogram[-1]:g}")
+        for name, fn in sorted(self.gauges.items()):
+            try:
+                values = fn()
+            except Exception as err:
+                journal.warning("metrics", "gauge_failed", gauge=name, error=str(err))
+                continue
+            if name in self.help:
+                out.append(f"# HELP {name} {self.help[name]}")
+            out.append(f"# TYPE {name} gauge")
+            for labels, value in values:
+                if value is not None:
+                    out.append(f"{name}{self.format_labels(self.labels(labels))} {value:g}")
+        return "\n".join(out) + "\n"
+
+    async def handle(self, request):
+        return aiohttp.web.Response(text=self.render(), content_type="text/plain", charset="utf-8")
+
+    async def serve(self, host, port, routes=()):
+        app = aiohttp.web.Application()
+        app.router.add_get("/metrics", self.handle)
+        for method, path, handler in routes:
+            app.router.add_route(method, path, handler)
+        runner = aiohttp.web.AppRunner(app, access_log=None)
+        await runner.setup()
+        try:
+            await aiohttp.web.TCPSite(runner, host, port).start()
+        except OSError as err:
+            # metrics are not worth taking the station down for
+            journal.error("metrics", "serve_failed", host=host, port=port, error=str(err))
+            await runner.cleanup()
+            return False
+        journal.info("metrics", "serving", url=f"http://{host}:{port}/metrics")
+        return True
+
+metrics = Metrics()
+
+def register_gauges():
+    metrics.gauge("pipeline_queue_depth", lambda: [({"stage": name}, stats['depth']) for name, stats in pipeline.stats().items()],
+                  "orders waiting in each pipeline stage")
+    metrics.gauge("pipeline_processed", lambda: [({"stage": name}, stats['processed']) for name, stats in pipeline.stats().items()])
+    metrics.gauge("print_queue_depth", lambda: [({"lane": lane}, s.load()) for lane, s in dispatcher.spoolers.items()],
+                  "receipts queued or printing per lane")
+    metrics.gauge("printer_online", lambda: [({"lane": lane}, int(s.healthy)) for lane, s in dispatcher.spoolers.items()])
+    metrics.gauge("printer_disconnects", lambda: [({"lane": lane}, s.pm.health.disconnects) for lane, s in dispatcher.spoolers.items()])
+    metrics.gauge("printer_reconnects", lambda: [({"lane": lane}, s.pm.health.reconnects) for lane, s in dispatcher.spoolers.items()])
+    metrics.gauge("printer_probe_ms", lambda: [({"lane": lane}, s.pm.health.stats()['probe_ms_p50']) for lane, s in dispatcher.spoolers.items()],
+                  "median printer status probe latency")
+    metrics.gauge("receipt_asset_cache_hits", lambda: [({"lane": lane, "asset": asset}, n) for lane, s in dispatcher.spoolers.items() for asset, n in s.pm.assets.hits.items()])
+    metrics.gauge("receipt_asset_cache_misses", lambda: [({"lane": lane, "asset": asset}, n) for lane, s in dispatcher.spoolers.items() for asset, n in s.pm.assets.misses.items()])
+    metrics.gauge("orders_total", lambda: [({}, odb.get_order_count())])
+    metrics.gauge("sync_backlog", lambda: [({}, odb.get_unsynced_order_count())], "orders not yet synced upstream")
+    metrics.gauge("sync_in_flight", lambda: [({}, len(sync_worker.in_flight))])
+    metrics.gauge("journal_dropped", lambda: [({}, journal.dropped)], "journal records overwritten before the writer saved them")
+    metrics.gauge("inventory_items", lambda: [({}, len(inventory.inventory))])
+    metrics.gauge("stock_available", lambda: [({"variant": id}, quantity - sold) for id, (quantity, sold) in odb.stock.items()],
+                  "units left per tracked variant after local sales")
+    metrics.gauge("inventory_age_seconds", lambda: [({}, time.time() - inventory.updated if inventory.updated else None)],
+                  "seconds since the inventory was last confirmed current")
 
 class OrderDB:
-    def __init__(self, path):
-            self.connection = sqlite3.connect(path)
+    def __init__(self, path, max_batch=64):
+        self.path = path
+        self.max_batch = max_batch
+        self.jobs = queue.Queue()
+        self.started = concurrent.futures.Future()
+        self.thread = threading.Thread(target=self.writer, name="orderdb", daemon=True)
+        self.thread.start()
+        self.started.result()
+
+    def writer(self):
+        try:
+            self.connection = sqlite3.connect(self.path, isolation_level=None)
+            self.connection.execute("PRAGMA journal_mode = WAL")
+            self.connection.execute("PRAGMA synchronous = NORMAL")
             self.connection.execute("PRAGMA foreign_keys = 1")
+            self.connection.execute("PRAGMA busy_timeout = 5000")
             cursor = self.connection.cursor()
             cursor.execute("CREATE TABLE IF NOT EXISTS orders (id INTEGER PRIMARY KEY AUTOINCREMENT, t TIMESTAMP DEFAULT CURRENT_TIMESTAMP, items INTEGER, total INTEGER, synced BOOLEAN DEFAULT FALSE)")
             cursor.execute("CREATE TABLE IF NOT EXISTS order_line (id INTEGER PRIMARY KEY AUTOINCREMENT, order_id INTEGER, item INTEGER, quantity INTEGER, pricelong INTEGER, FOREIGN KEY (order_id) REFERENCES orders (id))")
-            self.connection.commit()
-    def insert_order(self, order):
+            self.migrate()
+            self.load_counters()
+        except Exception as err:
+            self.started.set_exception(err)
+            return
+        self.started.set_result(True)
+
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            batch = [job]
+            # group commit: everything queued while the last commit was syncing goes in one transaction
+            while len(batch) < self.max_batch:
+                try:
+                    job = self.jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    self.jobs.put(None)
+                    break
+                batch.append(job)
+            self.run_batch(batch)
+        self.connection.close()
+
+    def migrate(self):
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        for v in range(version, len(MIGRATIONS)):
+            journal.info("db", "migrating", version=v+1)
+            self.connection.execute("BEGIN")
+            for sql in MIGRATIONS[v]:
+                self.connection.execute(sql)
+            self.connection.execute(f"PRAGMA user_version = {v+1}")
+            self.connection.execute("COMMIT")
+
+    def load_counters(self):
+        self.order_count = self._count("SELECT (SELECT count(id) FROM orders) + (SELECT count(id) FROM orders_archive)")
+        self.unsynced_count = self._count("SELECT count(id) FROM orders WHERE synced = 0")
+        self.relay_backlog = self._count("SELECT count(id) FROM relay WHERE forwarded = 0")
+        # variant id -> [quantity from upstream, units sold here since]; variants without an entry are not tracked
+        self.stock = {id: [quantity, sold] for id, quantity, sold in self.connection.execute("SELECT variant_id, quantity, sold FROM stock")}
+
+    def run_batch(self, batch):
+        results = []
+        durable = any(job[3] for job in batch)
+        writes = any(job[2] for job in batch)
+        try:
+            if durable:
+                self.connection.execute("PRAGMA synchronous = FULL")
+            if writes:
+                self.connection.execute("BEGIN")
+            for fn, args, write, _, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    if write:
+                        self.connection.execute("SAVEPOINT job")
+                    result = fn(*args)
+                    if write:
+                        self.connection.execute("RELEASE job")
+                    results.append((future, result, None))
+                except Exception as err:
+                    if write:
+                        self.connection.execute("ROLLBACK TO job")
+                        self.connection.execute("RELEASE job")
+                    results.append((future, None, err))
+            if writes:
+                self.connection.execute("COMMIT")
+        except sqlite3.Error as err:
+            journal.error("db", "commit_failed", jobs=len(batch), error=str(err))
+            # the whole transaction is gone (SQLite may already have rolled it back, e.g. on a full disk),
+            # so every job in the batch fails, including ones not reached yet
+            results = [(future, None, err) for _, _, _, _, future in batch if not future.cancelled()]
+            try:
+                if self.connection.in_transaction:
+                    self.connection.execute("ROLLBACK")
+                self.load_counters()
+            except sqlite3.Error as err:
+                journal.error("db", "rollback_failed", error=str(err))
+        finally:
+            try:
+                if durable:
+                    self.connection.execute("PRAGMA synchronous = NORMAL")
+            except sqlite3.Error as err:
+                journal.error("db", "pragma_failed", error=str(err))
+        for future, result, err in results:
+            if err is None:
+                future.set_result(result)
+            else:
+                future.set_exception(err)
+
+    def submit(self, fn, *args, write=False, durable=False):
+        future = concurrent.futures.Future()
+        self.jobs.put((fn, args, write, durable, future))
+        return future
+
+    async def call(self, fn, *args, write=False, durable=False):
+        return await asyncio.wrap_future(self.submit(fn, *args, write=write, durable=durable))
+
+    def close(self):
+        self.jobs.put(None)
+        self.thread.join()
+
+    async def insert_order(self, order, prefix, durable=True):
+        id, txn = await self.call(self._insert_order, order['count'], order['total'], order['lines'], prefix, order.get('cart_hash'), write=True, durable=durable)
+        return id, txn
+
+    def _insert_order(self, count, total, lines, prefix, cart_hash=None):
+        cart = collections.Counter()
+        for item, quantity, pricelong in lines:
+            cart[item] += quantity
+        tracked = [(quantity, item) for item, quantity in cart.items() if item in self.stock]
+        for quantity, item in tracked:
+            if self.stock[item][0] - self.stock[item][1] < quantity:
+                raise OrderError("item out of stock")
         cursor = self.connection.cursor()
-        cursor.execute("INSERT INTO orders (items, total) VALUES (?, ?)", (order['count'], order['total']))
+        cursor.execute("INSERT INTO orders (items, total, cart_hash) VALUES (?, ?, ?)", (count, total, cart_hash))
         id = cursor.lastrowid
-        print(f"created order {id}")
-        data = []
-        for item in order['i']:
-            data.append((id, item['v'], item['q'], inventory.inventory[item['v']].price_long))
-        cursor.executemany("INSERT INTO order_line (order_id, item, quantity, pricelong) VALUES(?, ?, ?, ?)", data)
-        self.connection.commit()
-        return id
-    def mark_order_synced(self, id):
+        txn = prefix+"-"+str(id)
+        cursor.execute("UPDATE orders SET txn = ? WHERE id = ?", (txn, id))
+        cursor.executemany("INSERT INTO order_line (order_id, item, quantity, pricelong) VALUES(?, ?, ?, ?)", [(id,)+line for line in lines])
+        cursor.executemany("UPDATE stock SET sold = sold + ? WHERE variant_id = ?", tracked)
+        for quantity, item in tracked:
+            self.stock[item][1] += quantity
+        self.order_count += 1
+        self.unsynced_count += 1
+        return id, txn
+
+    async def mark_order_synced(self, id):
         try:
-            cursor = self.connection.cursor()
-            cursor.execute("UPDATE orders SET synced=TRUE WHERE id = ?", (id,))
-            self.connection.commit()
+            await self.call(self._mark_order_synced, id, write=True)
         except sqlite3.Error as err:
-            print(f"error updating order: {err}")
-    def get_unsynced_orders(self):
+            journal.error("db", "mark_synced_failed", id=id, error=str(err))
+
+    def _mark_order_synced(self, id):
+        cursor = self.connection.execute("UPDATE orders SET synced = 1 WHERE id = ? AND synced = 0", (id,))
+        self.unsynced_count -= cursor.rowcount
+
+    async def mark_order_relayed(self, id):
+        try:
+            await self.call(self._mark_order_relayed, id, write=True)
+        except sqlite3.Error as err:
+            journal.error("db", "mark_relayed_failed", id=id, error=str(err))
+
+    def _mark_order_relayed(self, id):
+        # synced = 2: the booth hub has it queued, so it is off the sync queue but upstream stock doesn't reflect it yet
+        cursor = self.connection.execute("UPDATE orders SET synced = 2 WHERE id = ? AND synced = 0", (id,))
+        self.unsynced_count -= cursor.rowcount
+
+    def _get_relayed_txns(self, limit):
+        return self.connection.execute("SELECT id, COALESCE(txn, ? || '-' || id) FROM orders WHERE synced = 2 ORDER BY id LIMIT ?",
+                                       (os.environ.get('STATION', ''), limit)).fetchall()
+
+    def _settle_relayed(self, forwarded, unknown):
+        self.connection.executemany("UPDATE orders SET synced = 1 WHERE id = ? AND synced = 2", [(id,) for id in forwarded])
+        # the hub has no record of these, so they go back on this station's sync queue
+        cursor = self.connection.executemany("UPDATE orders SET synced = 0 WHERE id = ? AND synced = 2", [(id,) for id in unknown])
+        self.unsynced_count += cursor.rowcount
+
+    async def get_unsynced_orders(self, limit=None, exclude=()):
+        return await self.call(self._get_unsynced_orders, limit, exclude)
+
+    def _get_unsynced_orders(self, limit, exclude):
         orders = []
-        cursor = self.connection.cursor()
-        cursor.execute("SELECT id, total, t FROM orders WHERE synced=0")
-        for o in cursor.fetchall():
-            order = {}
-            order['device_id'] = os.environ['DEVICE_ID']
-            order['conference_id'] = os.environ['CONFERENCE_ID']
-            order['passcode'] = os.environ['PASSCODE']
-            order['timestamp'] = o[2]+"-00:00"
-            order['txn_num'] = os.environ['STATION']+"-"+str(o[0])
-            order['items'] = []
-            cursor.execute("SELECT item, quantity, pricelong FROM order_line WHERE order_id=?", (o[0],))
-            for i in cursor.fetchall():
-                order['items'].append({"variant_id": i[0], "quantity": i[1], "price_each_long": i[2]})
-            orders.append({"id": o[0], "order": order})
+        order = None
+        cursor = self.connection.execute("""SELECT o.id, o.t, o.txn, l.item, l.quantity, l.pricelong FROM orders o
+                                            LEFT JOIN order_line l ON l.order_id = o.id
+                                            WHERE o.synced = 0 ORDER BY o.id, l.id""")
+        for id, t, txn, item, quantity, pricelong in cursor:
+            if id in exclude:
+                continue
+            if order is None or order['id'] != id:
+                if limit is not None and len(orders) >= limit:
+                    break
+                order = {"id": id, "order": {
+                    'device_id': os.environ['DEVICE_ID'],
+                    'conference_id': os.environ['CONFERENCE_ID'],
+                    'passcode': os.environ['PASSCODE'],
+                    'timestamp': t+"-00:00",
+                    'txn_num': txn or os.environ['STATION']+"-"+str(id),
+                    'items': []}}
+                orders.append(order)
+            if item is not None:
+                order['order']['items'].append({"variant_id": item, "quantity": quantity, "price_each_long": pricelong})
         return orders
+
+    def _find_cart_hash(self, cart_hash, window):
+        return self.connection.execute("""SELECT cart_hash, txn, strftime('%s', t) FROM orders
+                                          WHERE cart_hash = ? AND t >= datetime('now', ?) ORDER BY t DESC LIMIT 1""",
+                                       (cart_hash, f"-{window} seconds")).fetchone()
+
+    def _get_recent_cart_hashes(self, window, limit):
+        return self.connection.execute("""SELECT cart_hash, txn, strftime('%s', t) FROM
+                                          (SELECT id, cart_hash, txn, t FROM orders ORDER BY id DESC LIMIT ?)
+                                          WHERE cart_hash IS NOT NULL AND t >= datetime('now', ?) ORDER BY id""",
+                                       (limit, f"-{window} seconds")).fetchall()
+
+    def _reconcile_stock(self, quantities, removed=()):
+        # upstream quantities already include synced orders, so only local sales upstream hasn't seen count
+        # against them; that includes orders still queued on the booth hub
+        sold = dict(self.connection.execute("""SELECT l.item, sum(l.quantity) FROM orders o
+                                               JOIN order_line l ON l.order_id = o.id
+                                               WHERE o.synced != 1 GROUP BY l.item"""))
+        self.connection.executemany("DELETE FROM stock WHERE variant_id = ?", [(id,) for id in removed])
+        rows = [(id, quantity, sold.get(id, 0)) for id, quantity in quantities.items()]
+        self.connection.executemany("INSERT OR REPLACE INTO stock (variant_id, quantity, sold) VALUES (?, ?, ?)", rows)
+        stock = dict(self.stock)
+        for id in removed:
+            stock.pop(id, None)
+        stock.update((id, [quantity, sold]) for id, quantity, sold in rows)
+        self.stock = stock
+
+    def _add_relay(self, txn, body):
+        # stations retry until they get an answer, so the same txn can arrive more than once;
+        # a different order under a txn already seen is a numbering clash and is refused
+        cursor = self.connection.execute("INSERT OR IGNORE INTO relay (txn, body) VALUES (?, ?)", (txn, body))
+        self.relay_backlog += cursor.rowcount
+        if cursor.rowcount:
+            return True
+        stored = self.connection.execute("SELECT body FROM relay WHERE txn = ?", (txn,)).fetchone()[0]
+        return json.loads(stored) == json.loads(body)
+
+    async def get_relayed_orders(self, limit=None, exclude=()):
+        return await self.call(self._get_relayed_orders, limit, exclude)
+
+    def _get_relayed_orders(self, limit, exclude):
+        orders = []
+        for id, body in self.connection.execute("SELECT id, body FROM relay WHERE forwarded = 0 ORDER BY id"):
+            if id in exclude:
+                continue
+            if limit is not None and len(orders) >= limit:
+                break
+            orders.append({"id": id, "order": json.loads(body)})
+        return orders
+
+    async def mark_relay_forwarded(self, id):
+        try:
+            await self.call(self._mark_relay_forwarded, id, write=True)
+        except sqlite3.Error as err:
+            journal.error("db", "mark_forwarded_failed", id=id, error=str(err))
+
+    def _get_relay_status(self, txns):
+        return dict(self.connection.execute(f"SELECT txn, forwarded FROM relay WHERE txn IN ({','.join('?'*len(txns))})", txns))
+
+    def _mark_relay_forwarded(self, id):
+        cursor = self.connection.execute("UPDATE relay SET forwarded = 1 WHERE id = ? AND forwarded = 0", (id,))
+        self.relay_backlog -= cursor.rowcount
+
+    def get_available_stock(self, id):
+        entry = self.stock.get(id)
+        return None if entry is None else entry[0] - entry[1]
+
     def get_order_count(self):
-        cursor = self.connection.execute("select count(id) from orders")
-        return cursor.fetchone()[0]
+        return self.order_count
+
     def get_unsynced_order_count(self):
-        cursor = self.connection.execute("select count(id) from orders where synced=false")
-        return cursor.fetchone()[0]
+        return self.unsynced_count
 
-        
+    async def add_print_job(self, txn, payload, lane):
+        return await self.call(self._add_print_job, txn, payload, lane, write=True)
 
+    def _add_print_job(self, txn, payload, lane):
+        return self.connection.execute("INSERT INTO print_jobs (txn, payload, lane) VALUES (?, ?, ?)", (txn, payload, lane)).lastrowid
 
-class Inventory:
-    def __init__(self):
-        self.inventory = {}
-        #self.fetch_inventory()
+    def _set_print_job_state(self, id, state, error=None):
+        attempts = 1 if state == "printing" else 0
+        self.connection.execute("UPDATE print_jobs SET state = ?, error = ?, attempts = attempts + ?, updated = CURRENT_TIMESTAMP WHERE id = ?", (state, error, attempts, id))
 
-    async def periodicly_update_inventory(self):
-        while True:
-            await asyncio.sleep(60)
-            await self.fetch_inventory()
+    def _get_print_jobs(self, lane, states, max_attempts):
+        cursor = self.connection.execute(f"SELECT id, payload FROM print_jobs WHERE lane IS ? AND state IN ({','.join('?'*len(states))}) AND attempts < ? ORDER BY id", (lane, *states, max_attempts))
+        return cursor.fetchall()
+
+    def _move_print_job(self, id, lane):
+        self.connection.execute("UPDATE print_jobs SET lane = ?, state = 'queued', updated = CURRENT_TIMESTAMP WHERE id = ?", (lane, id))
+
+    def _reset_interrupted_print_jobs(self, lane):
+        self.connection.execute("UPDATE print_jobs SET state = 'failed', error = 'interrupted' WHERE lane IS ? AND state = 'printing'", (lane,))
+
+    async def get_print_job_payload(self, txn):
+        return await self.call(self._get_print_job_payload, txn)
 
+    def _get_print_job_payload(self, txn):
+        row = self.connection.execute("SELECT payload FROM print_jobs WHERE txn = ? ORDER BY id DESC LIMIT 1", (txn,)).fetchone()
+        return row[0] if row else None
 
+    def _load_inventory(self):
+        rows = self.connection.execute("SELECT variant_id, data FROM inventory").fetchall()
+        meta = dict(self.connection.execute("SELECT key, value FROM inventory_meta").fetchall())
+        return rows, meta
 
-    async def fetch_inventory(self):
-        print("syncing inventory")
+    def _save_inventory(self, changed, removed, meta):
+        self.connection.executemany("INSERT OR REPLACE INTO inventory (variant_id, data) VALUES (?, ?)", changed)
+        self.connection.executemany("DELETE FROM inventory WHERE variant_id = ?", [(id,) for id in removed])
+        self.connection.executemany("INSERT OR REPLACE INTO inventory_meta (key, value) VALUES (?, ?)", meta.items())
+
+    async def periodicly_archive_orders(self, days):
+        while True:
+            archived = await self.call(self._archive_synced_orders, days, write=True)
+            if archived:
+                journal.info("db", "orders_archived", orders=archived, days=days)
+            await asyncio.sleep(3600)
+
+    def _archive_synced_orders(self, days):
+        cutoff = (datetime.datetime.utcnow() - datetime.timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+        where = "SELECT id FROM orders WHERE synced = 1 AND t < ?"
+        self.connection.execute(f"INSERT INTO orders_archive (id, t, items, total, synced, txn) SELECT id, t, items, total, synced, txn FROM orders WHERE id IN ({where})", (cutoff,))
+        self.connection.execute(f"INSERT INTO order_line_archive (id, order_id, item, quantity, pricelong) SELECT id, order_id, item, quantity, pricelong FROM order_line WHERE order_id IN ({where})", (cutoff,))
+        self.connection.execute(f"DELETE FROM order_line WHERE order_id IN ({where})", (cutoff,))
+        return self.connection.execute(f"DELETE FROM orders WHERE id IN ({where})", (cutoff,)).rowcount
+
+    def _count(self, sql):
+        return self.connection.execute(sql).fetchone()[0]
+
+
+# live and archived orders share one id space, so each export query runs against both pairs of tables
+ORDER_TABLES = (("orders", "order_line"), ("orders_archive", "order_line_archive"))
+
+def export_time(value):
+    # orders.t is CURRENT_TIMESTAMP, in UTC; times given without an offset are local
+    moment = datetime.datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.astimezone()
+    return moment.astimezone(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+def export_query(template, args, *head):
+    clauses, params = [], list(head)
+    if args.since:
+        clauses.append("o.t >= ?")
+        params.append(export_time(args.since))
+    if args.until:
+        clauses.append("o.t < ?")
+        params.append(export_time(args.until))
+    if args.synced is not None:
+        # synced = 2 is queued on the booth hub, which upstream hasn't confirmed yet
+        clauses.append("o.synced = 1" if args.synced else "o.synced != 1")
+    where = " AND ".join(clauses) or "1"
+    sql = " UNION ALL ".join(template.format(orders=orders, lines=lines, where=where) for orders, lines in ORDER_TABLES)
+    return sql, params * len(ORDER_TABLES)
+
+def export_orders(connection, args):
+    # one row per line, ordered by order, so the cursor streams and an order's lines arrive together
+    sql, params = export_query("""SELECT o.id, COALESCE(o.txn, ? || '-' || o.id), o.t, o.synced, o.items, o.total,
+                                         l.id, l.item, l.quantity, l.pricelong
+                                  FROM {orders} o LEFT JOIN {lines} l ON l.order_id = o.id WHERE {where}""",
+                               args, os.environ.get('STATION', ''))
+    rows = connection.execute(sql + " ORDER BY 1, 7", params)
+    if args.format == "csv":
+        yield ("txn", "t", "synced", "items", "total", "variant_id", "quantity", "price_each_long")
+        for id, txn, t, synced, items, total, line, item, quantity, pricelong in rows:
+            yield (txn, t, synced, items, total, item, quantity, pricelong)
+        return
+    for (id, txn, t, synced, items, total), lines in itertools.groupby(rows, key=lambda row: row[:6]):
+        yield {"txn": txn, "t": t, "synced": synced == 1, "items": items, "total": total,
+               "lines": [{"variant_id": row[7], "quantity": row[8], "price_each_long": row[9]} for row in lines if row[6] is not None]}
+
+def export_totals(connection, args):
+    sql, params = export_query("""SELECT l.item, l.quantity, l.quantity * l.pricelong AS revenue, l.order_id
+                                  FROM {orders} o JOIN {lines} l ON l.order_id = o.id WHERE {where}""", args)
+    rows = connection.execute(f"""SELECT s.item, json_extract(i.data, '$.product_code'), json_extract(i.data, '$.variant_code'),
+                                         json_extract(i.data, '$.product_title'), s.quantity, s.revenue, s.orders
+                                  FROM (SELECT item, sum(quantity) AS quantity, sum(revenue) AS revenue, count(DISTINCT order_id) AS orders
+                                        FROM ({sql}) GROUP BY item) s
+                                  LEFT JOIN inventory i ON i.variant_id = s.item ORDER BY s.revenue DESC""", params)
+    columns = ("variant_id", "product_code", "variant_code", "product_title", "quantity", "revenue_long", "orders")
+    if args.format == "csv":
+        yield columns
+        yield from rows
+    else:
+        for row in rows:
+            yield dict(zip(columns, row))
+
+def read_upstream_txns(path):
+    # one txn per line as exported upstream; any further comma separated columns are ignored
+    with (sys.stdin if path == "-" else open(path, encoding="utf-8")) as f:
+        return {line.split(",", 1)[0].strip().strip('"') for line in f if line.strip()}
+
+def export_missing(connection, args):
+    upstream = read_upstream_txns(args.upstream)
+    sql, params = export_query("SELECT COALESCE(o.txn, ? || '-' || o.id), o.t, o.synced, o.items, o.total FROM {orders} o WHERE {where}",
+                               args, os.environ.get('STATION', ''))
+    columns = ("txn", "t", "synced", "items", "total")
+    checked = missing = claimed = 0
+    if args.format == "csv":
+        yield columns
+    for row in connection.execute(sql + " ORDER BY 2", params):
+        checked += 1
+        if row[0] in upstream:
+            continue
+        missing += 1
+        # synced locally but absent upstream means the 200 was recorded and the order still got lost
+        claimed += row[2] == 1
+        yield row if args.format == "csv" else dict(zip(columns, row), synced=row[2] == 1)
+    print(f"{checked} local orders, {missing} missing upstream, {claimed} of those marked synced", file=sys.stderr)
+
+EXPORTS = {
+    "orders": export_orders,
+    "totals": export_totals,
+    "missing": export_missing,
+}
+
+def export(args):
+    load_dotenv()
+    path = args.db or os.environ.get('DB_PATH', 'database.db')
+    if not os.path.exists(path):
+        print(f"no orders database at {path}")
+        exit(-1)
+    # read only, so it is safe to run against a station that is still selling
+    connection = sqlite3.connect(pathlib.Path(path).resolve().as_uri() + "?mode=ro", uri=True)
+    if connection.execute("PRAGMA user_version").fetchone()[0] < 4:
+        print(f"{path} predates txn numbers; start the station once to migrate it")
+        exit(-1)
+    if args.what == "missing" and not args.upstream:
+        print("missing needs --upstream with the txn list downloaded from upstream")
+        exit(-1)
+    with (contextlib.nullcontext(sys.stdout) if args.out == "-" else open(args.out, "w", encoding="utf-8", newline="")) as out:
+        records = EXPORTS[args.what](connection, args)
+        if args.format == "csv":
+            csv.writer(out).writerows(records)
+        else:
+            out.writelines(json.dumps(record) + "\n" for record in records)
+    connection.close()
+
+class HubRoute:
+    # prefers the booth hub while it answers and falls back to the direct upstream URL when it doesn't
+    def __init__(self, hub, direct, retry=60):
+        self.hub = hub
+        self.direct = direct
+        self.retry = retry
+        self.down_until = 0
+
+    @property
+    def url(self):
+        if self.hub and time.monotonic() >= self.down_until:
+            return self.hub
+        return self.direct
+
+    def failed(self, url, error):
+        if url != self.hub or not self.hub:
+            return
+        if time.monotonic() >= self.down_until:
+            journal.warning("hub", "unreachable", url=url, error=error, retry_in=self.retry)
+            metrics.inc("hub_fallbacks_total")
+        self.down_until = time.monotonic() + self.retry
+
+class Inventory:
+    def __init__(self, url, interval=60, hub_url=None):
+        self.route = HubRoute(hub_url, url, retry=int(os.environ.get('HUB_RETRY', 60)))
+        self.interval = interval
+        self.inventory = {}
+        self.raw = {}
+        self.etag = None
+        self.last_modified = None
+        self.updated = None
+
+    def make_item(self, item):
+        return InventoryItem(item['variant_id'],
+                             item['product_code'],
+                             item['product_title'],
+                             item['variant_code'],
+                             item['variant_price'],
+                             item['variant_stock_status'],
+                             item['product_is_eligibility_restricted'])
+
+    async def load_snapshot(self):
+        rows, meta = await odb.call(odb._load_inventory)
+        inventory = {}
+        raw = {}
+        for id, data in rows:
+            try:
+                inventory[id] = self.make_item(json.loads(data))
+                raw[id] = data
+            except (ValueError, KeyError, TypeError) as err:
+                journal.warning("inventory", "bad_snapshot_row", variant=id, error=str(err))
+        self.inventory, self.raw = inventory, raw
+        self.etag = meta.get('etag')
+        self.last_modified = meta.get('last_modified')
+        if meta.get('updated'):
+            self.updated = float(meta['updated'])
+        journal.info("inventory", "snapshot_loaded", items=len(inventory))
+
+    async def periodicly_update_inventory(self):
+        timeout = aiohttp.ClientTimeout(total=30)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            while True:
+                await self.fetch_inventory(session)
+                await asyncio.sleep(self.interval)
+
+    async def fetch_inventory(self, session):
+        url = self.route.url
+        journal.debug("inventory", "refresh_started", url=url)
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
         try:
-            print(os.environ['INVENTORY_URL'])
-            async with aiohttp.ClientSession() as session:
-                response = await session.get(os.environ['INVENTORY_URL'])
-                #response.raise_for_status()
-                jsonResponse = await response.json()
-                print(jsonResponse)
-                for item in jsonResponse:
-                    self.inventory[item['variant_id']] = InventoryItem(item['variant_id'],
-                                                                item['product_code'],
-                                                                item['product_title'],
-                                                                item['variant_code'],
-                                                                item['variant_price'],
-                                                                item['variant_stock_status'],
-                                                                item['product_is_eligibility_restricted'])
-                #print(self.inventory)
-                
-        except HTTPError as http_err:
-            print(f'HTTP error: {http_err}')
+            async with session.get(url, headers=headers) as response:
+                if response.status == 304:
+                    journal.debug("inventory", "unchanged")
+                    self.updated = time.time()
+                    return
+                response.raise_for_status()
+                jsonResponse = await response.json(content_type=None)
+                etag = response.headers.get('ETag')
+                last_modified = response.headers.get('Last-Modified')
+            await self.apply(jsonResponse, etag, last_modified)
+        except aiohttp.ClientResponseError as http_err:
+            journal.warning("inventory", "refresh_failed", url=url, error=str(http_err))
+            if http_err.status >= 500:
+                self.route.failed(url, str(http_err))
         except Exception as err:
-            print(f'error requesting inventory: {err}')
+            journal.warning("inventory", "refresh_failed", url=url, error=str(err) or type(err).__name__)
+            self.route.failed(url, str(err) or type(err).__name__)
+        if url != self.route.url:
+            # the hub just dropped out, go straight to upstream rather than waiting a whole interval
+            await self.fetch_inventory(session)
+
+    async def follow_stock(self, url, wait=30):
+        # long-poll for quantity changes so sell-outs elsewhere show up between full refreshes
+        cursor = None
+        delay = 1
+        timeout = aiohttp.ClientTimeout(total=wait + 15)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            while True:
+                params = {"wait": wait}
+                if cursor is not None:
+                    params['since'] = cursor
+                try:
+                    async with session.get(url, params=params) as response:
+                        response.raise_for_status()
+                        data = await response.json(content_type=None)
+                    changes = {change['variant_id']: int(change['quantity']) for change in data['changes']}
+                    if changes:
+                        await odb.call(odb._reconcile_stock, changes, write=True)
+                        journal.info("stock", "updated", variants=len(changes))
+                    cursor = data['cursor']
+                    delay = 1
+                except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, TypeError, ValueError) as err:
+                    journal.warning("stock", "follow_failed", error=str(err) or type(err).__name__, retry_in=delay)
+                    await asyncio.sleep(delay)
+                    delay = min(delay*2, 60)
+
+    async def apply(self, items, etag, last_modified):
+        changed = []
+        seen = set()
+        inventory = None
+        for item in items:
+            id = item['variant_id']
+            seen.add(id)
+            data = json.dumps(item, sort_keys=True)
+            if self.raw.get(id) == data:
+                continue
+            if inventory is None:
+                inventory = dict(self.inventory)
+            inventory[id] = self.make_item(item)
+            changed.append((id, data))
+        removed = [id for id in self.raw if id not in seen]
+        if removed and inventory is None:
+            inventory = dict(self.inventory)
+        for id in removed:
+            del inventory[id]
+        if inventory is not None:
+            raw = dict(self.raw)
+            raw.update(changed)
+            for id in removed:
+                del raw[id]
+            # swap whole dicts so validation never sees a partial refresh
+            self.inventory, self.raw = inventory, raw
+        self.etag, self.last_modified, self.updated = etag, last_modified, time.time()
+        meta = {"etag": etag or "", "last_modified": last_modified or "", "updated": str(self.updated)}
+        await odb.call(odb._save_inventory, changed, removed, meta, write=True)
+        quantities = {item['variant_id']: int(item['variant_stock_quantity']) for item in items
+                      if item.get('variant_stock_quantity') is not None}
+        # the feed may not carry quantities at all; then /stock is the only source and its rows must survive a refresh
+        if quantities or removed:
+            await odb.call(odb._reconcile_stock, quantities, removed, write=True)
+        journal.info("inventory", "refreshed", changed=len(changed), removed=len(removed), total=len(inventory or self.inventory))
+
+# receipt layout; each step is an escpos method and its arguments, or one of
+# logo/qr/items/reprint which are expanded by PrinterManager.render_steps
+RECEIPT_TEMPLATE = [
+    ("set_with_default", {"align": "center"}),
+    ("logo", None),
+    ("set_with_default", {"align": "center", "custom_size": True, "width": 3, "height": 3, "density": 8}),
+    ("textln", "Order: {txn}"),
+    ("reprint", [("textln", "REPRINT")]),
+    ("set_with_default", {"align": "center"}),
+    ("textln", "on {date} at {time}"),
+    ("set", {"align": "center"}),
+    ("textln", "================================================"),
+    ("items", [
+        ("set_with_default", {"align": "left", "custom_size": True, "width": 2, "height": 2}),
+        ("textln", "{line}"),
+        ("set_with_default", {"custom_size": True, "width": 1, "height": 1}),
+        ("textln", "{description}"),
+        ("textln", ""),
+        ("set_with_default", {}),
+    ]),
+    ("set", {"align": "center"}),
+    ("textln", "-----------------------------------------------"),
+    ("set_with_default", {"align": "right", "custom_size": True, "width": 2, "height": 2}),
+    ("textln", "TOTAL: ${total}"),
+    ("set_with_default", {}),
+    ("textln", "all prices include Nevada State sales tax"),
+    ("set_with_default", {}),
+    ("qr", None),
+    ("cut", {}),
+    ("set", {"align": "center", "custom_size": True, "width": 3, "height": 3, "density": 8}),
+    ("logo", None),
+    ("textln", "Order: {txn}"),
+    ("reprint", [("textln", "REPRINT")]),
+    ("textln", "Total: ${total}"),
+    ("qr", None),
+    ("set_with_default", {}),
+    ("textln", "all prices include Nevada State sales tax"),
+    ("ln", {"count": 3}),
+    ("eject_slip", {}),
+    ("cut", {}),
+    ("eject_slip", {}),
+    ("set_with_default", {}),
+]
+
+class ReceiptAssets:
+    def __init__(self, logo_path, profile, cache_dir, qr_cache_size=8):
+        self.logo_path = logo_path
+        self.profile = profile
+        self.cache_dir = cache_dir
+        self.qr_cache_size = qr_cache_size
+        self.qr_cache = collections.OrderedDict()
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+        self.logo = self.load_logo()
+
+    def render(self):
+        from escpos import printer
+        return printer.Dummy(profile=self.profile)
+
+    def load_logo(self):
+        with open(self.logo_path, "rb") as f:
+            key = hashlib.sha256(f.read() + self.profile.encode()).hexdigest()
+        path = os.path.join(self.cache_dir, f"logo-{key}.bin")
+        try:
+            with open(path, "rb") as f:
+                self.hits['logo'] += 1
+                return f.read()
+        except FileNotFoundError:
+            pass
+        self.misses['logo'] += 1
+        d = self.render()
+        d.image(self.logo_path)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(path+".tmp", "wb") as f:
+                f.write(d.output)
+            os.replace(path+".tmp", path)
+        except OSError as err:
+            journal.warning("printer", "logo_cache_failed", error=str(err))
+        journal.info("printer", "logo_rasterized", path=self.logo_path, bytes=len(d.output))
+        return d.output
+
+    def qr(self, content):
+        if content in self.qr_cache:
+            self.qr_cache.move_to_end(content)
+            self.hits['qr'] += 1
+            return self.qr_cache[content]
+        self.misses['qr'] += 1
+        d = self.render()
+        d.qr(content, size=9, center=True)
+        self.qr_cache[content] = d.output
+        if len(self.qr_cache) > self.qr_cache_size:
+            self.qr_cache.popitem(last=False)
+        return d.output
+
+    def stats(self):
+        return {"hits": dict(self.hits), "misses": dict(self.misses)}
+
+def printer_configs():
+    # PRINTERS=LANE=usb:VENDOR:PRODUCT[/PROFILE],LANE=net:IP[/PROFILE]; otherwise the single PRINTER_* printer
+    if not os.environ.get('PRINTERS'):
+        if os.environ["PRINTER_CONN"] not in ("usb", "net", "network"):
+            print("unknown printer connection type")
+            exit(-1)
+        return [{"lane": os.environ['STATION'],
+                 "conn": os.environ["PRINTER_CONN"],
+                 "ip": os.environ.get("PRINTER_IP"),
+                 "vendor": os.environ.get("PRINTER_VENDOR"),
+                 "product": os.environ.get("PRINTER_PRODUCT"),
+                 "profile": os.environ['PRINTER_PROFILE']}]
+    configs = []
+    for spec in os.environ['PRINTERS'].split(","):
+        lane, _, target = spec.strip().partition("=")
+        # the lane is the txn prefix, so it has to carry the station id to stay unique across the booth;
+        # the separator keeps lane A1 on station A apart from station A1
+        station = os.environ['STATION']
+        if lane != station and not lane.startswith(station + "-"):
+            print(f"printer lane {lane} must be {station} or start with {station}-")
+            exit(-1)
+        if any(config['lane'] == lane for config in configs):
+            print(f"printer lane {lane} is listed twice")
+            exit(-1)
+        target, _, profile = target.partition("/")
+        parts = target.split(":")
+        config = {"lane": lane, "conn": parts[0], "profile": profile or os.environ['PRINTER_PROFILE']}
+        if parts[0] == "usb" and len(parts) == 3:
+            config.update(vendor=parts[1], product=parts[2])
+        elif parts[0] in ("net", "network") and len(parts) == 2:
+            config.update(ip=parts[1])
+        else:
+            print(f"bad printer spec {spec}")
+            exit(-1)
+        configs.append(config)
+    return configs
 
 class PrinterManager:
-    def __init__(self):
-        self.connect()
+    def __init__(self, config=None, device=None, assets=None):
+        self.config = config or {}
+        self.lane = self.config.get('lane')
+        self.lock = threading.RLock()
+        self.write_size = int(os.environ.get('PRINTER_WRITE_SIZE', 65536))
+        self.assets = assets or ReceiptAssets(os.environ.get('LOGO_PATH', '/home/bj/logo.png'),
+                                              self.config['profile'],
+                                              os.environ.get('ASSET_CACHE_DIR', 'asset-cache'))
+        self.printer = device
+        # a real printer is connected by its health monitor's first check, off the startup path
+        self.health = PrinterHealthMonitor(self, interval=float(os.environ.get('PRINTER_POLL_INTERVAL', 5)))
+        if self.printer is not None:
+            self.health.online.set()
 
     def connect(self):
-        if(os.environ["PRINTER_CONN"] == "net"):
-            self.connect_net(os.environ["PRINTER_IP"])
-        elif(os.environ["PRINTER_CONN"] == "usb"):
-            self.connect_usb(os.environ["PRINTER_VENDOR"], os.environ["PRINTER_PRODUCT"])
+        if self.printer is not None:
+            try:
+                self.printer.close()
+            except Exception:
+                pass
+            self.printer = None
+        if(self.config['conn'] in ("net", "network")):
+            self.connect_net(self.config['ip'])
+        elif(self.config['conn'] == "usb"):
+            self.connect_usb(self.config['vendor'], self.config['product'])
         else:
-            print("unknown printer connection type")
-            exit(-1)        
+            raise ValueError(f"unknown printer connection type {self.config['conn']}")
 
     def connect_usb(self, vendor, product):
-        print("connecting to usb printer")
-        print(f"printer.Usb({vendor}, {product})")
-        self.printer = printer.Usb(int(vendor, base=16), int(product, base=16), in_ep=0x81, out_ep=0x01, profile=os.environ['PRINTER_PROFILE'])
-            
-    def connect_net(self, ip):
-        print("connecting to network printer")
-        self.printer = printer.Network(ip, profile=os.environ['PRINTER_PROFILE'])
+        from escpos import printer
+        journal.info("printer", "connecting", lane=self.lane, conn="usb", vendor=vendor, product=product)
+        self.printer = printer.Usb(int(vendor, base=16), int(product, base=16), in_ep=0x81, out_ep=0x01, profile=self.config['profile'])
 
-    def check_connection(self):
-        if self.printer.is_online():
-            return True
-        return False
+    def connect_net(self, ip):
+        from escpos import printer
+        journal.info("printer", "connecting", lane=self.lane, conn="network", ip=ip)
+        self.printer = printer.Network(ip, profile=self.config['profile'])
 
     def make_order_line(self, sku, size, price):
         item = sku+" : "+size
@@ -142,52 +1172,265 @@ class PrinterManager:
         item+=str(price)
         return item
 
-    def print_order(self, order):
-        if not self.check_connection():
-            self.connect()
-        self.printer.set_with_default(align="center")
-        self.printer.image("/home/bj/logo.png")
-        self.printer.set_with_default(align="center", custom_size=True, width=3, height=3, density=8)
-        self.printer.textln(f"Order: {order['txn']}")
-        self.printer.set_with_default(align="center")
+    def render_receipt(self, target, order, template=None):
         now = datetime.datetime.now()
-        self.printer.textln(f"on {now.date()} at {now.time()}")
-        self.printer.set(align="center")
-        self.printer.textln("================================================")
-        total = 0
-        for item in order["items"]:
-            self.printer.set_with_default(align="left", custom_size=True, width=2, height=2)
-            #self.printer.textln(f"{item['sku']} : {item['size']}")
-            self.printer.textln(self.make_order_line(item['sku'], item['size'], item['price']))
-            self.printer.set_with_default(custom_size=True, width=1, height=1)
-            self.printer.textln(item['description'])
-            #self.printer.set_with_default(align="right", double_height=True, double_width=True)
-            #self.printer.text(f"${item['price']}")
-            self.printer.textln()
-            self.printer.set_with_default()
-        self.printer.set(align="center")
-        self.printer.textln("-----------------------------------------------")
-        self.printer.set_with_default(align="right", custom_size=True, width=2, height=2)
-        self.printer.textln(f"TOTAL: ${order['total']}")
-        self.printer.set_with_default()
-        self.printer.textln("all prices include Nevada State sales tax")
-        self.printer.set_with_default()
-        self.printer.qr(order['qr'], size=9,center=True)
-        self.printer.cut()
-        self.printer.set(align="center", custom_size=True, width=3, height=3, density=8)
-        self.printer.image("/home/bj/logo.png")
-        self.printer.textln(f"Order: {order['txn']}")
-        self.printer.textln(f"Total: ${order['total']}")
-        self.printer.qr(order['qr'], size=9,center=True)
-        self.printer.set_with_default()
-        self.printer.textln("all prices include Nevada State sales tax")
-        self.printer.ln(3)
-        self.printer.eject_slip()
-        self.printer.cut()
-        self.printer.eject_slip()
-        self.printer.set_with_default()
+        fields = {"txn": order['txn'], "total": order['total'], "date": now.date(), "time": now.time()}
+        self.render_steps(target, template or RECEIPT_TEMPLATE, fields, order)
+
+    def render_steps(self, target, steps, fields, order):
+        for op, arg in steps:
+            if op == "textln":
+                target.textln(arg.format(**fields))
+            elif op == "logo":
+                target._raw(self.assets.logo)
+            elif op == "qr":
+                target._raw(self.assets.qr(order['qr']))
+            elif op == "items":
+                # the pick list still gets one entry per unit; jobs spooled before quantities existed have none
+                for item in order["items"]:
+                    line = self.make_order_line(item['sku'], item['size'], item['price'])
+                    item_fields = dict(fields, line=line, description=item['description'])
+                    for _ in range(item.get('quantity', 1)):
+                        self.render_steps(target, arg, item_fields, order)
+            elif op == "reprint":
+                if order.get('reprint'):
+                    self.render_steps(target, arg, fields, order)
+            else:
+                getattr(target, op)(**arg)
+
+    def compose_receipt(self, order):
+        buffer = self.assets.render()
+        self.render_receipt(buffer, order)
+        return buffer.output
+
+    def print_order(self, order):
+        data = self.compose_receipt(order)
+        if self.printer is None:
+            raise IOError(f"printer for lane {self.lane} is not connected")
+        for i in range(0, len(data), self.write_size):
+            self.printer._raw(data[i:i+self.write_size])
+
+class PrinterHealthMonitor:
+    def __init__(self, pm, interval=5, max_delay=30):
+        self.pm = pm
+        self.interval = interval
+        self.max_delay = max_delay
+        self.online = threading.Event()
+        self.status = {"online": False, "paper": None, "cover_open": None, "checked": None, "error": None}
+        self.disconnects = 0
+        self.reconnects = 0
+        self.probe_ms = collections.deque(maxlen=256)
+
+    def probe(self):
+        start = time.perf_counter()
+        with self.pm.lock:
+            if self.pm.printer is None:
+                raise IOError("not connected")
+            online = self.pm.printer.is_online()
+            paper = self.pm.printer.paper_status() if online else None
+            offline = self.pm.printer.query_status(RT_STATUS_OFFLINE) if online else []
+        self.probe_ms.append((time.perf_counter() - start) * 1000)
+        return {"online": online, "paper": paper, "cover_open": bool(offline[0] & 0x04) if offline else None}
+
+    def update(self, status, error=None):
+        online = error is None and status.get('online', False)
+        self.status = dict(status, online=online, checked=time.time(), error=error)
+        if online:
+            if not self.online.is_set() and self.disconnects:
+                self.reconnects += 1
+                journal.info("printer", "online", lane=self.pm.lane)
+            self.online.set()
+        elif self.online.is_set():
+            self.online.clear()
+            self.disconnects += 1
+            journal.error("printer", "offline", lane=self.pm.lane, error=error)
+
+    def mark_offline(self, error):
+        self.update({}, error)
+
+    def reconnect(self):
+        with self.pm.lock:
+            self.pm.connect()
+
+    async def check(self):
+        try:
+            self.update(await asyncio.to_thread(self.probe))
+        except Exception as err:
+            self.update({}, str(err))
+        if not self.online.is_set():
+            try:
+                await asyncio.to_thread(self.reconnect)
+                self.update(await asyncio.to_thread(self.probe))
+            except Exception as err:
+                journal.warning("printer", "reconnect_failed", lane=self.pm.lane, error=str(err))
+        return self.online.is_set()
+
+    async def run(self):
+        # startup makes the first check itself; only check straight away if that hasn't happened
+        delay = self.interval if self.status['checked'] else 0
+        while True:
+            await asyncio.sleep(delay)
+            if await self.check():
+                delay = self.interval
+            else:
+                delay = min(max(delay, self.interval)*2, self.max_delay)
+
+    def stats(self):
+        probes = sorted(self.probe_ms)
+        return {"status": self.status,
+                "disconnects": self.disconnects,
+                "reconnects": self.reconnects,
+                "probe_ms_p50": probes[len(probes)//2] if probes else None,
+                "probe_ms_max": probes[-1] if probes else None}
+
+class PrintSpooler:
+    def __init__(self, pm, maxsize=32, max_attempts=3, handoff_interval=1):
+        self.pm = pm
+        self.lane = pm.lane
+        self.dispatcher = None
+        self.max_attempts = max_attempts
+        self.handoff_interval = handoff_interval
+        self.printing = False
+        self.assigned = 0
+        self.jobs = queue.Queue(maxsize=maxsize)
+        self.overflow = False
+        self.pending = set()
+        self.pending_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.worker, name=f"spooler-{self.lane}", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    async def submit(self, order):
+        job_id = await odb.add_print_job(order['txn'], json.dumps(order), self.lane)
+        self.enqueue(job_id, order)
+        return job_id
+
+    async def reprint(self, txn):
+        payload = await odb.get_print_job_payload(txn)
+        if payload is None:
+            journal.warning("spooler", "reprint_unknown", txn)
+            return False
+        journal.info("spooler", "reprint", txn, lane=self.lane)
+        order = json.loads(payload)
+        order['reprint'] = True
+        await self.submit(order)
+        return True
+
+    def enqueue(self, job_id, order):
+        with self.pending_lock:
+            if job_id in self.pending:
+                return
+            try:
+                self.jobs.put_nowait((job_id, order))
+                self.pending.add(job_id)
+            except queue.Full:
+                journal.warning("spooler", "queue_full", lane=self.lane, job=job_id)
+                self.overflow = True
+
+    def set_state(self, job_id, state, error=None):
+        odb.submit(odb._set_print_job_state, job_id, state, error, write=True)
+
+    def requeue(self, states):
+        for job_id, payload in odb.submit(odb._get_print_jobs, self.lane, states, self.max_attempts).result():
+            self.enqueue(job_id, json.loads(payload))
+
+    def worker(self):
+        odb.submit(odb._reset_interrupted_print_jobs, self.lane, write=True).result()
+        self.requeue(("queued", "failed"))
+        while True:
+            if self.overflow and self.jobs.empty():
+                self.overflow = False
+                self.requeue(("queued",))
+            job_id, order = self.jobs.get()
+            if not self.wait_online(job_id, order):
+                with self.pending_lock:
+                    self.pending.discard(job_id)
+                continue
+            self.printing = True
+            self.set_state(job_id, "printing")
+            failed = False
+            try:
+                with self.pm.lock:
+                    self.pm.print_order(order)
+                self.set_state(job_id, "done")
+                metrics.mark(order['txn'], "printed")
+                journal.info("spooler", "receipt_printed", order['txn'], lane=self.lane, job=job_id)
+            except Exception as err:
+                journal.error("spooler", "print_failed", order['txn'], lane=self.lane, job=job_id, error=str(err))
+                self.set_state(job_id, "failed", str(err))
+                self.pm.health.mark_offline(str(err))
+                metrics.inc("print_failures_total", {"lane": self.lane})
+                failed = True
+            with self.pending_lock:
+                self.pending.discard(job_id)
+            self.printing = False
+            if failed and self.wait_online(job_id, order):
+                # the health monitor reconnected before another lane could take the job
+                self.requeue(("failed",))
+
+    def wait_online(self, job_id, order):
+        # while this printer is down, hand the job to a healthy lane rather than sit on it;
+        # False means another lane took it
+        while not self.pm.health.online.is_set():
+            if self.dispatcher is not None and self.dispatcher.handoff(self, job_id, order):
+                return False
+            self.pm.health.online.wait(self.handoff_interval)
+        return True
+
+    @property
+    def healthy(self):
+        return self.pm.health.online.is_set()
+
+    def load(self):
+        return self.jobs.qsize() + self.printing + self.assigned
+
+class PrintDispatcher:
+    def __init__(self, spoolers, scanner_lanes=None):
+        self.spoolers = {spooler.lane: spooler for spooler in spoolers}
+        self.scanner_lanes = scanner_lanes or {}
+        for spooler in spoolers:
+            spooler.dispatcher = self
+
+    def start(self):
+        for spooler in self.spoolers.values():
+            spooler.start()
+            loop.create_task(spooler.pm.health.run())
+
+    def choose(self, source=None):
+        spooler = self.spoolers.get(self.scanner_lanes.get(source))
+        if spooler is not None and spooler.healthy:
+            return spooler
+        healthy = [s for s in self.spoolers.values() if s.healthy] or list(self.spoolers.values())
+        return min(healthy, key=lambda s: s.load())
+
+    def handoff(self, source, job_id, order):
+        # called from the spooler thread of a lane whose printer is down
+        healthy = [s for s in self.spoolers.values() if s is not source and s.healthy]
+        if not healthy:
+            return False
+        target = min(healthy, key=lambda s: s.load())
+        odb.submit(odb._move_print_job, job_id, target.lane, write=True).result()
+        journal.warning("spooler", "job_moved", order['txn'], job=job_id, lane=source.lane, to=target.lane)
+        metrics.inc("print_jobs_moved_total", {"lane": source.lane})
+        target.enqueue(job_id, order)
+        return True
+
+    async def reprint(self, txn, source=None):
+        return await self.choose(source).reprint(txn)
+
+def scanner_lane_map():
+    # SCANNER_LANES=<device under /dev/input/by-path>=LANE,...
+    lanes = {}
+    for spec in os.environ.get('SCANNER_LANES', '').split(","):
+        if "=" in spec:
+            path, _, lane = spec.strip().rpartition("=")
+            lanes[os.path.join("/dev/input/by-path", path)] = lane
+    return lanes
 
 class InventoryItem:
+    __slots__ = ("sku", "id", "description", "size", "price_long", "price", "stock_staus", "restricted", "error", "receipt")
+
     def __init__(self, id, sku, description, size, price, stock_status, restricted):
         self.sku = sku
         self.id = id
@@ -197,187 +1440,747 @@ class InventoryItem:
         self.price = int(price/100)
         self.stock_staus = stock_status
         self.restricted = restricted
+        # worked out once per refresh so validation is a single attribute check per line
+        if restricted == "Y":
+            self.error = "item is restricted"
+        elif stock_status == "OUT":
+            self.error = "item out of stock"
+        else:
+            self.error = None
+        self.receipt = {"id": id, "sku": sku, "price": self.price, "description": description, "size": size}
 
     def __str__(self):
         return str(self.id)+":"+str(self.sku)+" "+self.description+"("+self.size+")"+" $"+str(self.price)
 
-def bulk_sync_order():
-    orders = odb.get_unsynced_orders()
-    for o in orders:
-        print(f"attempting to sync order {o['id']}")
-        loop.create_task(sync_order(o['order'], o['id']))
-        
+class SyncWorker:
+    def __init__(self, url, concurrency=4, batch_size=20, base_delay=2, max_delay=300, hub_url=None, fetch=None, mark=None,
+                 relay_interval=5):
+        self.route = HubRoute(hub_url, url, retry=int(os.environ.get('HUB_RETRY', 60)))
+        self.relay_interval = relay_interval
+        # a station drains its own unsynced orders, the hub passes in its relay queue instead
+        self.fetch = fetch
+        self.mark = mark
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.in_flight = set()
+        self.attempts = {}
+        self.next_attempt = {}
+        self.wakeup = asyncio.Event()
+
+    def wake(self):
+        self.wakeup.set()
+
+    async def run(self):
+        connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60)
+        timeout = aiohttp.ClientTimeout(total=30)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            while True:
+                self.wakeup.clear()
+                delay = await self.drain(session)
+                if self.route.hub and self.mark is None and await self.confirm_relayed(session):
+                    delay = self.relay_interval if delay is None else min(delay, self.relay_interval)
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def drain(self, session):
+        while True:
+            now = loop.time()
+            waiting = {id for id, t in self.next_attempt.items() if t > now}
+            batch = await (self.fetch or odb.get_unsynced_orders)(limit=self.batch_size, exclude=self.in_flight | waiting)
+            if not batch:
+                break
+            journal.debug("sync", "batch", orders=len(batch))
+            for o in batch:
+                self.in_flight.add(o['id'])
+            semaphore = asyncio.Semaphore(self.concurrency)
+            results = await asyncio.gather(*(self.send(session, semaphore, o['order'], o['id']) for o in batch))
+            if not any(results):
+                break
+        if not self.next_attempt:
+            return None
+        return max(0, min(self.next_attempt.values()) - loop.time())
+
+    async def send(self, session, semaphore, orderobj, id):
+        url = self.route.url
+        try:
+            async with semaphore:
+                async with session.post(url, json=orderobj) as resp:
+                    await resp.read()
+                    if resp.status == 200:
+                        relayed = self.mark is None and url == self.route.hub
+                        if relayed:
+                            await odb.mark_order_relayed(id)
+                        else:
+                            await (self.mark or odb.mark_order_synced)(id)
+                        self.attempts.pop(id, None)
+                        self.next_attempt.pop(id, None)
+                        metrics.mark(orderobj['txn_num'], "synced")
+                        journal.info("sync", "order_relayed" if relayed else "order_synced", orderobj['txn_num'], id=id)
+                        return True
+                    error = f"status {resp.status}"
+                    if resp.status >= 500:
+                        self.route.failed(url, error)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            error = str(err) or type(err).__name__
+            self.route.failed(url, error)
+        finally:
+            self.in_flight.discard(id)
+        if url != self.route.url:
+            # the hub dropped out under this order; resend it upstream now rather than backing off
+            self.wake()
+            return False
+        metrics.inc("sync_failures_total")
+        delay = self.backoff(id)
+        journal.warning("sync", "sync_failed", orderobj['txn_num'], id=id, error=error,
+                        attempt=self.attempts[id], retry_in=round(delay, 1))
+        return False
 
-async def sync_order(orderobj, id):
-    print("in sync order")
+    async def confirm_relayed(self, session):
+        # asks the hub which of the orders it queued have gone upstream; True while some are still waiting
+        relayed = await odb.call(odb._get_relayed_txns, 200)
+        if not relayed:
+            return False
+        url = self.route.hub.rsplit("/", 1)[0] + "/relay/status"
+        try:
+            async with session.post(url, json={"txns": [txn for id, txn in relayed]}) as resp:
+                resp.raise_for_status()
+                status = await resp.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as err:
+            journal.debug("sync", "relay_status_failed", error=str(err) or type(err).__name__)
+            return True
+        forwarded, unknown = set(status['forwarded']), set(status['unknown'])
+        settled = [id for id, txn in relayed if txn in forwarded]
+        lost = [id for id, txn in relayed if txn in unknown]
+        if settled or lost:
+            await odb.call(odb._settle_relayed, settled, lost, write=True)
+        if lost:
+            journal.warning("sync", "relay_lost", orders=len(lost))
+            self.wake()
+        return len(settled) + len(lost) < len(relayed) or len(relayed) == 200
+
+    def backoff(self, id):
+        attempts = self.attempts.get(id, 0) + 1
+        self.attempts[id] = attempts
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        delay = delay/2 + random.uniform(0, delay/2)
+        self.next_attempt[id] = loop.time() + delay
+        return delay
+
+class Hub:
+    # booth hub: serves one cached copy of the inventory feed to the stations on the LAN and
+    # queues their orders durably, forwarding them upstream over a single pooled session
+    def __init__(self, db, inventory_url, sync_url, interval=60, concurrency=4, batch_size=20):
+        self.db = db
+        self.inventory_url = inventory_url
+        self.interval = interval
+        self.feed = None
+        self.etag = None
+        self.upstream_etag = None
+        self.updated = None
+        self.forwarder = SyncWorker(sync_url, concurrency=concurrency, batch_size=batch_size,
+                                    fetch=db.get_relayed_orders, mark=db.mark_relay_forwarded)
+
+    async def load(self):
+        _, meta = await self.db.call(self.db._load_inventory)
+        if meta.get('hub_feed'):
+            self.feed = meta['hub_feed'].encode()
+            self.etag = meta.get('hub_etag')
+            self.upstream_etag = meta.get('hub_upstream_etag') or None
+            journal.info("hub", "feed_loaded", bytes=len(self.feed))
+
+    async def periodicly_refresh(self):
+        timeout = aiohttp.ClientTimeout(total=30)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            while True:
+                await self.refresh(session)
+                await asyncio.sleep(self.interval)
+
+    async def refresh(self, session):
+        headers = {'If-None-Match': self.upstream_etag} if self.upstream_etag else {}
+        try:
+            async with session.get(self.inventory_url, headers=headers) as response:
+                if response.status == 304:
+                    self.updated = time.time()
+                    return
+                response.raise_for_status()
+                feed = await response.read()
+                json.loads(feed)
+                upstream_etag = response.headers.get('ETag')
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as err:
+            journal.warning("hub", "refresh_failed", error=str(err) or type(err).__name__)
+            return
+        self.updated = time.time()
+        if feed == self.feed:
+            return
+        self.feed, self.upstream_etag = feed, upstream_etag
+        self.etag = '"%s"' % hashlib.sha1(feed).hexdigest()
+        meta = {"hub_feed": feed.decode(), "hub_etag": self.etag, "hub_upstream_etag": upstream_etag or ""}
+        await self.db.call(self.db._save_inventory, [], [], meta, write=True)
+        journal.info("hub", "feed_refreshed", bytes=len(feed))
+
+    async def inventory(self, request):
+        if self.feed is None:
+            # no copy yet; stations fall back to upstream on a 5xx
+            return aiohttp.web.Response(status=503)
+        if request.headers.get('If-None-Match') == self.etag:
+            return aiohttp.web.Response(status=304)
+        return aiohttp.web.Response(body=self.feed, content_type="application/json", headers={"ETag": self.etag})
+
+    async def addtxn(self, request):
+        body = await request.text()
+        try:
+            txn = json.loads(body)['txn_num']
+        except (ValueError, KeyError, TypeError):
+            return aiohttp.web.Response(status=400)
+        if not await self.db.call(self.db._add_relay, txn, body, write=True, durable=True):
+            journal.error("hub", "txn_conflict", txn, source=request.remote)
+            metrics.inc("hub_txn_conflicts_total")
+            return aiohttp.web.json_response({"status": "conflict"}, status=409)
+        journal.info("hub", "order_relayed", txn, source=request.remote)
+        self.forwarder.wake()
+        return aiohttp.web.json_response({"status": "queued"})
+
+    async def relay_status(self, request):
+        # stations keep counting relayed orders against stock until they show up as forwarded here
+        try:
+            txns = [str(txn) for txn in (await request.json())['txns']][:500]
+        except (ValueError, KeyError, TypeError):
+            return aiohttp.web.Response(status=400)
+        known = await self.db.call(self.db._get_relay_status, txns) if txns else {}
+        return aiohttp.web.json_response({"forwarded": [txn for txn in txns if known.get(txn)],
+                                          "unknown": [txn for txn in txns if txn not in known]})
+
+    async def start(self, host, port):
+        await self.load()
+        app = aiohttp.web.Application()
+        app.router.add_get("/inventory", self.inventory)
+        app.router.add_post("/merch_addtxn.php", self.addtxn)
+        app.router.add_post("/relay/status", self.relay_status)
+        app.router.add_get("/metrics", metrics.handle)
+        self.runner = aiohttp.web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = aiohttp.web.TCPSite(self.runner, host, port)
+        await site.start()
+        self.tasks = [loop.create_task(self.periodicly_refresh()), loop.create_task(self.forwarder.run())]
+        host, port = self.runner.addresses[0][:2]
+        journal.info("hub", "serving", url=f"http://{host}:{port}")
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await self.runner.cleanup()
+
+class OrderError(Exception):
+    pass
+
+# compact QR payload: "M1" + base45(varint item count, varint variant/quantity pairs, txn)
+# base45 stays inside the QR alphanumeric set so codes are denser and need fewer keystrokes
+COMPACT_PREFIX = "M1"
+BASE45 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ $%*+-./:"
+BASE45_INDEX = {c: i for i, c in enumerate(BASE45)}
+
+def b45encode(data):
+    out = []
+    for i in range(0, len(data) - 1, 2):
+        n = data[i]*256 + data[i+1]
+        n, c = divmod(n, 45)
+        e, d = divmod(n, 45)
+        out += (BASE45[c], BASE45[d], BASE45[e])
+    if len(data) % 2:
+        d, c = divmod(data[-1], 45)
+        out += (BASE45[c], BASE45[d])
+    return "".join(out)
+
+def b45decode(text):
+    out = bytearray()
     try:
-        async with aiohttp.ClientSession() as session:
-            resp = await session.post('https://confmgr3.junctorconf.net/conf/merch_addtxn.php', json=orderobj)
-            print("sent order")
-            print(resp)
-            print("content")
-            print(await resp.json())
-            if resp.status == 200:
-                odb.mark_order_synced(id)
-                print("order synced")
-                bulk_sync_order()
+        for i in range(0, len(text), 3):
+            chunk = [BASE45_INDEX[c] for c in text[i:i+3]]
+            if len(chunk) == 3:
+                n = chunk[0] + chunk[1]*45 + chunk[2]*2025
+                if n > 0xffff:
+                    raise ValueError("base45 value out of range")
+                out.extend(divmod(n, 256))
+            elif len(chunk) == 2:
+                n = chunk[0] + chunk[1]*45
+                if n > 0xff:
+                    raise ValueError("base45 value out of range")
+                out.append(n)
             else:
-                print("failed to sync order")
-    except aiohttp.web_exceptions.HTTPError as http_err:
-        print(f'HTTP error: {http_err}')
-    except Exception as err:
-        print(f'error sending order: {err}')
-
-def parse_order(order):
-    print(order)
+                raise ValueError("truncated base45")
+    except KeyError:
+        raise ValueError("invalid base45 character")
+    return bytes(out)
+
+def put_varint(out, n):
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def get_varint(data, pos):
+    n = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+def encode_compact_order(order):
+    out = bytearray()
+    put_varint(out, len(order['i']))
+    for item in order['i']:
+        put_varint(out, int(item['v']))
+        put_varint(out, int(item['q']))
+    out += order.get('txn', '').encode()
+    return COMPACT_PREFIX + b45encode(bytes(out))
+
+def decode_compact_order(payload):
+    try:
+        data = b45decode(payload[len(COMPACT_PREFIX):])
+        count, pos = get_varint(data, 0)
+        items = []
+        for _ in range(count):
+            v, pos = get_varint(data, pos)
+            q, pos = get_varint(data, pos)
+            items.append({"v": v, "q": q})
+        txn = data[pos:].decode()
+    except (ValueError, IndexError, UnicodeDecodeError) as err:
+        journal.debug("pipeline", "compact_decode_failed", error=str(err))
+        raise OrderError("unable to parse qr code")
+    return {"i": items, "txn": txn}
+
+ValidatedOrder = collections.namedtuple("ValidatedOrder", "order count total lines items")
+
+ORDER_KEYS = frozenset(("i", "txn"))
+# units in one order; the receipt picks one line per unit, and anything beyond this is a crafted code
+MAX_ORDER_UNITS = 50
+
+def validate_order(order):
+    if not ORDER_KEYS.issuperset(order):
+        raise OrderError("unknown item in order")
+    if "i" not in order:
+        raise OrderError("order missing items")
+    if "txn" not in order:
+        raise OrderError("order missing txnid")
+    elif order["txn"] != "":
+        raise OrderError("unexpected txn value")
+    if not isinstance(order["i"], list):
+        raise OrderError("malformed order")
+
+    catalog = inventory.inventory
+    stock = odb.stock
+    cart = {}
     total = 0
     count = 0
-
-    orderobj = {}
+    for item in order["i"]:
+        try:
+            v = item['v']
+            q = item['q']
+        except (KeyError, TypeError):
+            raise OrderError("malformed order")
+        # variant ids are ints; anything else, unhashable lists included, never reaches the catalog
+        if type(v) is not int:
+            raise OrderError("malformed order")
+        entry = catalog.get(v)
+        if entry is None:
+            raise OrderError("unknown item in order")
+        if entry.error:
+            raise OrderError(entry.error)
+        try:
+            quantity = int(q)
+        except (TypeError, ValueError):
+            raise OrderError("invalid quantity")
+        if quantity <= 0 or count + quantity > MAX_ORDER_UNITS:
+            raise OrderError("invalid quantity")
+        total += quantity*entry.price
+        count += quantity
+        quantity += cart.get(v, 0)
+        if v in stock and quantity > stock[v][0] - stock[v][1]:
+            raise OrderError("item out of stock")
+        cart[v] = quantity
+    lines = []
     items = []
+    for v, quantity in cart.items():
+        entry = catalog[v]
+        lines.append((v, quantity, entry.price_long))
+        items.append(dict(entry.receipt, quantity=quantity))
+    items.sort(key=lambda d: d['sku'])
+    return ValidatedOrder(order, count, total, lines, items)
+
+class DuplicateDetector:
+    # remembers recently persisted carts so a re-fired scan doesn't print and sync a second order;
+    # the window only needs to cover a scanner firing twice, since the next customer may well buy the same thing
+    def __init__(self, window=5, size=512):
+        self.window = window
+        self.size = size
+        self.recent = collections.OrderedDict()
+        self.evicted = 0
+
+    @staticmethod
+    def cart_hash(lines, source=None):
+        # keyed by scanner too: the same cart on another scanner is another customer
+        cart = collections.Counter()
+        for id, quantity, pricelong in lines:
+            cart[id] += quantity
+        return hashlib.sha256(json.dumps([source, sorted(cart.items())]).encode()).hexdigest()
+
+    async def load(self):
+        for cart, txn, t in await odb.call(odb._get_recent_cart_hashes, self.window, self.size):
+            self.remember(cart, txn, float(t))
+        journal.info("pipeline", "duplicates_loaded", carts=len(self.recent))
+
+    def remember(self, cart, txn, t):
+        self.recent[cart] = [txn, t]
+        self.recent.move_to_end(cart)
+        while len(self.recent) > self.size:
+            _, (_, evicted) = self.recent.popitem(last=False)
+            self.evicted = max(self.evicted, evicted)
+
+    async def check(self, cart):
+        # returns [txn, time] of the earlier order, or None after reserving the cart for this one
+        now = time.time()
+        entry = self.recent.get(cart)
+        if entry is None and self.evicted > now - self.window:
+            # the cache has dropped carts that are still inside the window, fall back to the index
+            row = await odb.call(odb._find_cart_hash, cart, self.window)
+            entry = self.recent.get(cart) or (row and [row[1], float(row[2])])
+        if entry and entry[1] > now - self.window:
+            return entry
+        # txn stays None until the order is persisted, so concurrent identical scans match too
+        self.remember(cart, None, now)
+        return None
+
+    def record(self, cart, txn):
+        entry = self.recent.get(cart)
+        if entry is not None:
+            entry[0] = txn
+
+    def release(self, cart):
+        self.recent.pop(cart, None)
+
+class PipelineStage:
+    def __init__(self, name, handler, concurrency=1, maxsize=16, shed=False):
+        self.name = name
+        self.handler = handler
+        self.concurrency = concurrency
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.shed = shed
+        self.processed = 0
+        self.shed_count = 0
+        self.errors = 0
+
+class OrderPipeline:
+    def __init__(self, queue_size=16, duplicates=None):
+        self.subscribers = []
+        self.duplicates = duplicates
+        self.scans = itertools.count(1)
+        self.stages = [
+            PipelineStage("decode", self.decode, maxsize=queue_size, shed=True),
+            PipelineStage("validate", self.validate, maxsize=queue_size),
+            PipelineStage("persist", self.persist, concurrency=4, maxsize=queue_size),
+            PipelineStage("print", self.print_receipt, maxsize=queue_size),
+            PipelineStage("sync", self.sync, maxsize=queue_size, shed=True),
+        ]
 
-    order_keys = order.keys()
-    for k in order_keys:
-        if k not in ["i", "txn"]:
-            q.put_nowait({"error": "unknown item in order"})
-            return False
-    if "i" not in order:
-        q.put_nowait({"error": "order missing items"})
-        return False
-    if "txn" not in order:
-        q.put_nowait({"error": "order missing txnid"})
-        return False
-    elif order["txn"] != "":
-        q.put_nowait({"error": "unexpected txn value"})
-        return False
-    oi = []
-
-    if 'i' in order:
-        for item in order["i"]:
-            print(item)
-            if "v" not in item or "q" not in item:
-                q.put_nowait({"error": "malformed order"})
-                print("malformed order")
+    def subscribe(self):
+        events = asyncio.Queue()
+        self.subscribers.append(events)
+        return events
+
+    def publish(self, event):
+        for events in self.subscribers:
+            events.put_nowait(event)
+
+    def start(self):
+        for i, stage in enumerate(self.stages):
+            next_stage = self.stages[i+1] if i+1 < len(self.stages) else None
+            for _ in range(stage.concurrency):
+                loop.create_task(self.worker(stage, next_stage))
+
+    def submit(self, raw, source=None):
+        # the scan id ties together journal records from before the order has a txn
+        scan = next(self.scans)
+        journal.info("pipeline", "scan_received", scan=scan, source=source, chars=len(raw))
+        return self.put(self.stages[0], {"raw": raw, "source": source, "scan": scan, "marks": {"scanned": time.monotonic()}})
+
+    def put(self, stage, item):
+        if stage.shed:
+            try:
+                stage.queue.put_nowait(item)
+            except asyncio.QueueFull:
+                stage.shed_count += 1
+                metrics.inc("pipeline_shed_total", {"stage": stage.name})
+                journal.warning("pipeline", "shed", scan=item.get('scan'), stage=stage.name)
+                if stage is self.stages[0]:
+                    self.publish({"error": "station busy"})
                 return False
-            if item['v'] in inventory.inventory:
-                if inventory.inventory[item['v']].restricted == "Y":
-                    q.put_nowait({"error": "item is restricted"})
-                    print(f"item {item['v']} is restricted")
-                    return False
-                if inventory.inventory[item['v']].stock_staus == "OUT":
-                    q.put_nowait({"error": "item out of stock"})
-                    print(f"item {item['v']} is out of stock")
-                    return False
+            return True
+        return stage.queue.put(item)
+
+    async def worker(self, stage, next_stage):
+        while True:
+            item = await stage.queue.get()
+            try:
+                result = await stage.handler(item)
+                if result is not None and next_stage is not None:
+                    put = self.put(next_stage, result)
+                    if asyncio.iscoroutine(put):
+                        await put
+            except OrderError as err:
+                metrics.inc("orders_rejected_total", {"reason": str(err)})
+                journal.info("pipeline", "order_rejected", item.get('txn'), scan=item.get('scan'), stage=stage.name, reason=str(err))
+                self.publish({"error": str(err)})
+            except Exception as err:
+                stage.errors += 1
+                journal.error("pipeline", "stage_failed", item.get('txn'), scan=item.get('scan'), stage=stage.name, error=repr(err))
+                self.publish({"error": "internal error"})
+            finally:
+                stage.processed += 1
+                stage.queue.task_done()
+
+    def stats(self):
+        return {stage.name: {"depth": stage.queue.qsize(),
+                             "processed": stage.processed,
+                             "shed": stage.shed_count,
+                             "errors": stage.errors} for stage in self.stages}
+
+    async def decode(self, job):
+        raw = job['raw']
+        if raw.startswith(COMPACT_PREFIX):
+            job['order'] = decode_compact_order(raw)
+            return job
+        try:
+            data = json.loads(raw)
+        except json.JSONDecodeError:
+            raise OrderError("unable to parse qr code")
+        if not isinstance(data, dict):
+            raise OrderError("malformed order")
+        if "control" in data:
+            if data['control'] == "reprint":
+                # a receipt is what gets merch handed over, so only a code carrying the staff key may reprint one
+                key = os.environ.get('REPRINT_KEY', '')
+                if not key or not hmac.compare_digest(str(data.get('key', '')).encode(), key.encode()):
+                    journal.warning("pipeline", "reprint_refused", data.get('txn'), scan=job['scan'], source=job['source'])
+                    raise OrderError("reprint not allowed")
+                if await dispatcher.reprint(data.get('txn'), job['source']):
+                    self.publish({"reprint": data['txn']})
                 else:
-                    print(inventory.inventory[item['v']])
-                    quantity = int(item['q'])
-                    if(quantity > 0):
-                        for i in range(quantity):
-                            oi.append({"id": item['v'], "sku": inventory.inventory[item['v']].sku, "price": inventory.inventory[item['v']].price, "description": inventory.inventory[item['v']].description, "size": inventory.inventory[item['v']].size})
-                        items.append({"variant_id": item['v'], "quantity": item['q'], "price_each_long": inventory.inventory[item['v']].price_long})
-                        print(item['q'])
-                        total += quantity*inventory.inventory[item['v']].price
-                        count += int(item['q'])
-                    else:
-                        q.put_nowait({"error": "invalid quantity"})
-                        return False
+                    raise OrderError("unknown txn")
+            elif data['control'] == "info":
+                # the display may be in another process, so send the lines rather than have it look them up
+                self.publish({"control": "info", "lines": station_info()})
             else:
-                print(f"item {item['v']} not in inventory")
-                q.put_nowait({"error": "unknown item in order"})
-                return False
-        eo = order.copy()
-        eo['count'] = count
-        eo['total'] = total
-        id = odb.insert_order(eo)
-
-        sorted_items = sorted(oi, key=lambda d: d['sku'])
-        order["txn"] = os.environ['STATION']+"-"+str(id)
-        o = {"txn": os.environ['STATION']+"-"+str(id),
-            "total": total,
-            "count": count,
-            "items": sorted_items,
-            "qr": json.dumps(order) }
-
-        pm.print_order(o)
-
-        orderobj['device_id'] = os.environ['DEVICE_ID']
-        orderobj['conference_id'] = os.environ['CONFERENCE_ID']
-        orderobj['passcode'] = os.environ['PASSCODE']
-        orderobj['timestamp'] = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S-00:00")
-        orderobj['txn_num'] = os.environ['STATION']+"-"+str(id)
-        orderobj['items'] = items
-
-        print(orderobj)
-        loop.create_task(sync_order(orderobj, id))
-        #inventory.fetch_inventory()
-        #bulk_sync_order()
-
-        return True
-    else:
-        return False
-    
-async def handle_barcode_scan(device):
-    print(device.name)
-    scancodes = {
-        # Scancode: ASCIICode
-        0: None, 1: u'ESC', 2: u'1', 3: u'2', 4: u'3', 5: u'4', 6: u'5', 7: u'6', 8: u'7', 9: u'8',
-        10: u'9', 11: u'0', 12: u'-', 13: u'=', 14: u'BKSP', 15: u'TAB', 16: u'q', 17: u'w', 18: u'e', 19: u'r',
-        20: u't', 21: u'y', 22: u'u', 23: u'i', 24: u'o', 25: u'p', 26: u'[', 27: u']', 28: u'CRLF', 29: u'LCTRL',
-        30: u'a', 31: u's', 32: u'd', 33: u'f', 34: u'g', 35: u'h', 36: u'j', 37: u'k', 38: u'l', 39: u';',
-        40: u'\'', 41: u'`', 42: u'LSHFT', 43: u'\\', 44: u'z', 45: u'x', 46: u'c', 47: u'v', 48: u'b', 49: u'n',
-        50: u'm', 51: u',', 52: u'.', 53: u'/', 54: u'RSHFT', 56: u'LALT', 57: u' ', 71: u'7', 72: u'8', 73: u'9',
-        75: u'4', 76: u'5', 77: u'6', 79: u'1', 80: u'2', 81: u'3', 82: u'0', 100: u'RALT'
-    }
-
-    capscodes = {
-        0: None, 1: u'ESC', 2: u'!', 3: u'@', 4: u'#', 5: u'$', 6: u'%', 7: u'^', 8: u'&', 9: u'*',
-        10: u'(', 11: u')', 12: u'_', 13: u'+', 14: u'BKSP', 15: u'TAB', 16: u'Q', 17: u'W', 18: u'E', 19: u'R',
-        20: u'T', 21: u'Y', 22: u'U', 23: u'I', 24: u'O', 25: u'P', 26: u'{', 27: u'}', 28: u'CRLF', 29: u'LCTRL',
-        30: u'A', 31: u'S', 32: u'D', 33: u'F', 34: u'G', 35: u'H', 36: u'J', 37: u'K', 38: u'L', 39: u':',
-        40: u'"', 41: u'~', 42: u'LSHFT', 43: u'|', 44: u'Z', 45: u'X', 46: u'C', 47: u'V', 48: u'B', 49: u'N',
-        50: u'M', 51: u'<', 52: u'>', 53: u'?', 54: u'RSHFT', 56: u'LALT', 57: u' ', 71: u'7', 72: u'8', 73: u'9',
-        75: u'4', 76: u'5', 77: u'6', 79: u'1', 80: u'2', 81: u'3', 82: u'0', 100: u'RALT'
-    }
-
+                self.publish(data)
+            return None
+        job['order'] = data
+        return job
+
+    async def validate(self, job):
+        job.update(validate_order(job['order'])._asdict())
+        job['marks']['validated'] = time.monotonic()
+        journal.debug("pipeline", "order_validated", scan=job['scan'], count=job['count'], total=job['total'])
+        return job
+
+    async def persist(self, job):
+        if self.duplicates is not None:
+            job['cart_hash'] = DuplicateDetector.cart_hash(job['lines'], job['source'])
+            duplicate = await self.duplicates.check(job['cart_hash'])
+            if duplicate is not None:
+                await self.duplicate(job, duplicate[0])
+                return None
+        spooler = dispatcher.choose(job['source'])
+        # count the job against its lane now so concurrent orders spread across printers
+        spooler.assigned += 1
+        try:
+            job['id'], job['txn'] = await odb.insert_order(job, spooler.lane, durable=True)
+        except Exception:
+            spooler.assigned -= 1
+            if self.duplicates is not None:
+                self.duplicates.release(job['cart_hash'])
+            raise
+        if self.duplicates is not None:
+            self.duplicates.record(job['cart_hash'], job['txn'])
+        job['spooler'] = spooler
+        job['marks']['persisted'] = time.monotonic()
+        journal.info("pipeline", "order_created", job['txn'], scan=job['scan'], id=job['id'], lane=spooler.lane,
+                     count=job['count'], total=job['total'])
+        metrics.trace(job['txn'], job['marks'])
+        return job
+
+    async def duplicate(self, job, txn):
+        metrics.inc("duplicate_scans_total")
+        journal.info("pipeline", "duplicate_scan", txn, scan=job['scan'], source=job['source'])
+        # never reprint on a cart match, it may be someone else's order; staff can reprint if it was a lost receipt
+        self.publish({"duplicate": txn})
+
+    async def print_receipt(self, job):
+        order = job['order']
+        order["txn"] = job['txn']
+        o = {"txn": order["txn"],
+            "total": job['total'],
+            "count": job['count'],
+            "items": job['items'],
+            "qr": encode_compact_order(order) }
+        try:
+            await job['spooler'].submit(o)
+        finally:
+            job['spooler'].assigned -= 1
+        metrics.inc("orders_accepted_total", {"lane": job['spooler'].lane})
+        self.publish({"accepted": o['txn']})
+        return job
+
+    async def sync(self, job):
+        sync_worker.wake()
+
+SCANCODES = {
+    # Scancode: ASCIICode
+    0: None, 1: u'ESC', 2: u'1', 3: u'2', 4: u'3', 5: u'4', 6: u'5', 7: u'6', 8: u'7', 9: u'8',
+    10: u'9', 11: u'0', 12: u'-', 13: u'=', 14: u'BKSP', 15: u'TAB', 16: u'q', 17: u'w', 18: u'e', 19: u'r',
+    20: u't', 21: u'y', 22: u'u', 23: u'i', 24: u'o', 25: u'p', 26: u'[', 27: u']', 28: u'CRLF', 29: u'LCTRL',
+    30: u'a', 31: u's', 32: u'd', 33: u'f', 34: u'g', 35: u'h', 36: u'j', 37: u'k', 38: u'l', 39: u';',
+    40: u'\'', 41: u'`', 42: u'LSHFT', 43: u'\\', 44: u'z', 45: u'x', 46: u'c', 47: u'v', 48: u'b', 49: u'n',
+    50: u'm', 51: u',', 52: u'.', 53: u'/', 54: u'RSHFT', 56: u'LALT', 57: u' ', 71: u'7', 72: u'8', 73: u'9',
+    75: u'4', 76: u'5', 77: u'6', 79: u'1', 80: u'2', 81: u'3', 82: u'0', 100: u'RALT'
+}
+
+CAPSCODES = {
+    0: None, 1: u'ESC', 2: u'!', 3: u'@', 4: u'#', 5: u'$', 6: u'%', 7: u'^', 8: u'&', 9: u'*',
+    10: u'(', 11: u')', 12: u'_', 13: u'+', 14: u'BKSP', 15: u'TAB', 16: u'Q', 17: u'W', 18: u'E', 19: u'R',
+    20: u'T', 21: u'Y', 22: u'U', 23: u'I', 24: u'O', 25: u'P', 26: u'{', 27: u'}', 28: u'CRLF', 29: u'LCTRL',
+    30: u'A', 31: u'S', 32: u'D', 33: u'F', 34: u'G', 35: u'H', 36: u'J', 37: u'K', 38: u'L', 39: u':',
+    40: u'"', 41: u'~', 42: u'LSHFT', 43: u'|', 44: u'Z', 45: u'X', 46: u'C', 47: u'V', 48: u'B', 49: u'N',
+    50: u'M', 51: u'<', 52: u'>', 53: u'?', 54: u'RSHFT', 56: u'LALT', 57: u' ', 71: u'7', 72: u'8', 73: u'9',
+    75: u'4', 76: u'5', 77: u'6', 79: u'1', 80: u'2', 81: u'3', 82: u'0', 100: u'RALT'
+}
+
+def build_keymap(codes):
+    # only single printable characters end up in a payload; ESC, BKSP, modifiers etc. map to 0
+    keymap = bytearray(256)
+    for code, key in codes.items():
+        if key is not None and len(key) == 1:
+            keymap[code] = ord(key)
+    return bytes(keymap)
+
+KEYMAP = build_keymap(SCANCODES)
+SHIFT_KEYMAP = build_keymap(CAPSCODES)
+
+class ScanDecoder:
+    EV_KEY = 1
     LEFT_SHIFT = 42
-    KEY_STATE_PRESSED = 1
-    KEY_STATE_RELEASED = 0
+    RIGHT_SHIFT = 54
     RETURN = 28
+    KEY_STATE_PRESSED = 1
 
-    caps = False
-    pending_string = ''
-
-    async for event in device.async_read_loop():
-        if event.type == evdev.ecodes.EV_KEY:
-            data = evdev.categorize(event)
-            if data.scancode == LEFT_SHIFT:
-                if data.keystate == KEY_STATE_PRESSED:
-                    caps = True
-                if data.keystate == KEY_STATE_RELEASED:
-                    caps = False
-
-            if data.keystate == 1: # Down events only
-                if caps:
-                    key_lookup = capscodes.get(data.scancode) or None
-                else:
-                    key_lookup = scancodes.get(data.scancode) or None
-
-                if (data.scancode == RETURN):
-                    print(pending_string)
-                    try:
-                        data = json.loads(pending_string)
-                        await q.put(data)
-                        print("put a scan on the queue")
-                    except json.JSONDecodeError:
-                        print("unable to parse json")
-                        data = {"error": "unable to parse qr code json"}
-                        await q.put(data)                    
-                    pending_string = ''
-                elif (data.scancode != LEFT_SHIFT) and (key_lookup != None):
-                    pending_string += key_lookup
+    def __init__(self, name, submit, history=256):
+        self.name = name
+        self.submit = submit
+        self.buffer = bytearray()
+        self.caps = False
+        self.first_key = None
+        self.scans = 0
+        self.typing_ms = collections.deque(maxlen=history)
+        self.handoff_ms = collections.deque(maxlen=history)
+
+    def feed(self, events):
+        buffer = self.buffer
+        for event in events:
+            if event.type != self.EV_KEY:
+                continue
+            code = event.code
+            if code == self.LEFT_SHIFT or code == self.RIGHT_SHIFT:
+                self.caps = event.value != 0
+                continue
+            if event.value != self.KEY_STATE_PRESSED or code > 255:
+                continue
+            if code == self.RETURN:
+                self.finish(event.sec + event.usec/1000000)
+                continue
+            key = (SHIFT_KEYMAP if self.caps else KEYMAP)[code]
+            if key:
+                if not buffer:
+                    self.first_key = event.sec + event.usec/1000000
+                buffer.append(key)
+
+    def finish(self, crlf):
+        payload = self.buffer.decode("ascii")
+        self.buffer.clear()
+        if not payload:
+            return
+        self.submit(payload, self.name)
+        # event timestamps come from the kernel's wall clock, so compare against time.time()
+        handoff = (time.time() - crlf) * 1000
+        typing = (crlf - self.first_key) * 1000
+        self.scans += 1
+        self.typing_ms.append(typing)
+        self.handoff_ms.append(handoff)
+        metrics.observe("scan_typing_seconds", typing/1000)
+        metrics.observe("scan_handoff_seconds", handoff/1000)
+        journal.debug("scanner", "scan_read", source=self.name, payload=payload, typing_ms=round(typing, 1), handoff_ms=round(handoff, 1))
+
+    def stats(self):
+        return {"scans": self.scans,
+                "typing_ms": sorted(self.typing_ms),
+                "handoff_ms": sorted(self.handoff_ms)}
+
+async def handle_barcode_scan(device):
+    journal.info("scanner", "reading", source=device.path, name=device.name)
+    decoder = ScanDecoder(device.path, pipeline.submit)
+    scan_decoders.append(decoder)
+    while True:
+        decoder.feed(await device.async_read())
+
+def station_info():
+    return [
+        f"Station has processed {odb.get_order_count()} orders",
+        f"{odb.get_unsynced_order_count()} orders are unsynced",
+        f"Station id: {os.environ['STATION']}",
+        printer_line()
+    ]
+
+async def handle_reprint(request):
+    # staff reprints come from the station itself, via the reprint subcommand
+    if request.remote not in ("127.0.0.1", "::1"):
+        return aiohttp.web.Response(status=403)
+    txn = request.match_info['txn']
+    if not await dispatcher.reprint(txn):
+        return aiohttp.web.json_response({"status": "unknown txn"}, status=404)
+    pipeline.publish({"reprint": txn})
+    return aiohttp.web.json_response({"status": "queued"})
+
+def request_reprint(args):
+    load_dotenv()
+    url = f"http://127.0.0.1:{os.environ.get('METRICS_PORT', 9810)}/reprint/{urllib.parse.quote(args.txn)}"
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, method="POST"), timeout=10):
+            print(f"reprint of {args.txn} queued")
+    except urllib.error.HTTPError as err:
+        print(f"reprint of {args.txn} failed: {err.code} {err.reason}")
+        exit(-1)
+    except urllib.error.URLError as err:
+        print(f"station not reachable at {url}: {err.reason}")
+        exit(-1)
+
+def printer_line():
+    spoolers = list(dispatcher.spoolers.values())
+    if len(spoolers) == 1:
+        return f"printer ready: {spoolers[0].healthy}"
+    ready = sum(1 for s in spoolers if s.healthy)
+    return f"printers ready: {ready}/{len(spoolers)}"
 
 class DisplayUI:
-    def __init__(self):
+    def __init__(self, events, info, on_quit=None):
+        # imported here so the core process of a UI_PROCESS station never loads it
+        global pygame
+        import pygame
         pygame.init()
         pygame.display.set_caption("Merch")
         self.screen = pygame.display.set_mode((0,0), pygame.FULLSCREEN | pygame.NOFRAME)
@@ -403,26 +2206,69 @@ class DisplayUI:
 
         self.font = pygame.font.Font('freesansbold.ttf', 64)
 
-        self.text_lines = [
-            #"Please scan your QR code",
-            f"Station has processed {odb.get_order_count()} orders",
-            f"{odb.get_unsynced_order_count()} orders are unsynced",
-            f"Station id: {os.environ['STATION']}",
-            f"printer ready: {pm.check_connection()}"
-        ]
+        self.text_lines = []
+        self.background = self.PRIMARY
+        self.frames = collections.OrderedDict()
+        self.frame_cache_size = 16
+        self.drawn_key = None
+        self.drawn_rects = []
+        self.poll_interval = 0.25
 
-        self.screen.fill(self.PRIMARY)
-        
         self.DEBOUNCE = pygame.USEREVENT+1
         self.SCANERROR = pygame.USEREVENT+2
         self.GOODORDER = pygame.USEREVENT+3
         self.BADORDER = pygame.USEREVENT+4
         self.ORDERERROR = pygame.USEREVENT+5
         self.INFO = pygame.USEREVENT+6
-
+        self.REPRINT = pygame.USEREVENT+7
+        self.BUSY = pygame.USEREVENT+8
+        self.DUPLICATE = pygame.USEREVENT+9
+        self.STATUS = pygame.USEREVENT+10
+
+        self.events = events
+        self.info = info
+        self.on_quit = on_quit
         self.running = True
         pygame.time.set_timer(self.DEBOUNCE, 10000, loops=1)
 
+    def set_screen(self, color, lines, timeout=5000):
+        self.background = color
+        self.text_lines = list(lines)
+        if timeout:
+            pygame.time.set_timer(self.DEBOUNCE, timeout, loops=1)
+
+    def frame(self):
+        key = (self.background, tuple(self.text_lines))
+        if key in self.frames:
+            self.frames.move_to_end(key)
+            return key, self.frames[key]
+        surface = pygame.Surface(self.screen.get_size()).convert()
+        surface.fill(self.background)
+        surface.blit(self.header, self.header_rect)
+        rects = []
+        for txt_surf, txt_rect in self.render_text():
+            surface.blit(txt_surf, txt_rect)
+            rects.append(txt_rect)
+        self.frames[key] = (surface, rects)
+        if len(self.frames) > self.frame_cache_size:
+            self.frames.popitem(last=False)
+        return key, (surface, rects)
+
+    def draw(self):
+        key, (surface, rects) = self.frame()
+        if key == self.drawn_key:
+            return False
+        if self.drawn_key is None or self.drawn_key[0] != key[0]:
+            dirty = [self.screen.get_rect()]
+        else:
+            dirty = self.drawn_rects + rects
+        for rect in dirty:
+            self.screen.blit(surface, rect, rect)
+        pygame.display.update(dirty)
+        self.drawn_key = key
+        self.drawn_rects = rects
+        return True
+
     def render_text(self):
         rendered_fonts = []
         ws = pygame.display.get_window_size()
@@ -439,142 +2285,393 @@ class DisplayUI:
             rendered_fonts.append((txt_surf, txt_rect))
         return rendered_fonts
 
-
     async def run(self):
+        self.set_screen(self.PRIMARY, self.info, timeout=None)
+        self.draw()
         while self.running:
             try:
-                event = q.get_nowait()
-                q.task_done()
-                print("got an event")
-                print(event)
+                event = await asyncio.wait_for(self.events.get(), timeout=self.poll_interval)
+                journal.debug("ui", "screen_event", data=event)
                 if "error" in event:
-                    if event['error'] == "unable to parse qr code json":
+                    if event['error'] == "unable to parse qr code":
                         pygame.event.post(pygame.event.Event(self.SCANERROR))
                     elif event['error'] in ["unknown item in order",
                                             "invalid quantity",
                                             "order missing items",
                                             "order missing txnid",
                                             "malformed order", 
-                                            "unexpected txn value"]:
+                                            "unexpected txn value",
+                                            "unknown txn",
+                                            "reprint not allowed"]:
                         pygame.event.post(pygame.event.Event(self.BADORDER))
                     elif event['error'] in ["item is restricted",
                                             "item out of stock"]:
                         pygame.event.post(pygame.event.Event(self.ORDERERROR))
+                    elif event['error'] in ["station busy",
+                                            "internal error"]:
+                        pygame.event.post(pygame.event.Event(self.BUSY))
                 elif "control" in event:
                     if event['control'] == "info":
-                        pygame.event.post(pygame.event.Event(self.INFO))
-
-                else:
-                    if parse_order(event):
-                        pygame.event.post(pygame.event.Event(self.GOODORDER))
-                    #else:
-                    #    pygame.event.post(pygame.event.Event(self.BADORDER))
-
-                #self.screen.fill(self.BLUE)
-            except asyncio.QueueEmpty:
+                        pygame.event.post(pygame.event.Event(self.INFO, lines=event['lines']))
+                    elif event['control'] == "status":
+                        pygame.event.post(pygame.event.Event(self.STATUS, lines=event['lines']))
+                elif "reprint" in event:
+                    pygame.event.post(pygame.event.Event(self.REPRINT, txn=event['reprint']))
+                elif "duplicate" in event:
+                    pygame.event.post(pygame.event.Event(self.DUPLICATE, txn=event['duplicate']))
+                elif "accepted" in event:
+                    pygame.event.post(pygame.event.Event(self.GOODORDER))
+            except asyncio.TimeoutError:
                 pass
 
-            self.screen.blit(self.header, self.header_rect)
-            #self.screen.blit(message, message_rect)
-            
-            for txt_surf, txt_rect in self.render_text():
-                self.screen.blit(txt_surf, txt_rect)
-
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
                     self.running = False
-                    for task in asyncio.all_tasks():
-                        task.cancel()
+                    if self.on_quit is not None:
+                        self.on_quit()
+                    else:
+                        for task in asyncio.all_tasks():
+                            task.cancel()
                 if event.type == self.SCANERROR:
-                    self.screen.fill(self.ERROR)
-                    self.text_lines.clear()
-                    self.text_lines.append("Unable to parse order")
-                    self.text_lines.append("See a Goon to complete your order")
-                    pygame.time.set_timer(self.DEBOUNCE, 5000, loops=1)
+                    self.set_screen(self.ERROR, ["Unable to parse order",
+                                                 "See a Goon to complete your order"])
                 if event.type == self.DEBOUNCE:
-                    self.screen.fill(self.PRIMARY)
-                    self.text_lines.clear()
-                    self.text_lines.append("Please scan your QR code")
+                    self.set_screen(self.PRIMARY, ["Please scan your QR code"], timeout=None)
                 if event.type == self.GOODORDER:
-                    self.screen.fill(self.SUCCESS)
-                    self.text_lines.clear()
-                    self.text_lines.append("Thank you for your order")
-                    self.text_lines.append("Please take your receipt")
-                    self.text_lines.append("Turn in the long receipt")
-                    self.text_lines.append("Keep the short receipt")
-                    pygame.time.set_timer(self.DEBOUNCE, 5000, loops=1)
+                    self.set_screen(self.SUCCESS, ["Thank you for your order",
+                                                   "Please take your receipt",
+                                                   "Turn in the long receipt",
+                                                   "Keep the short receipt"])
                 if event.type == self.BADORDER:
-                    self.screen.fill(self.ERROR)
-                    self.text_lines.clear()
-                    self.text_lines.append("Unable to validate order")
-                    self.text_lines.append("Are you being naughty?")
-                    self.text_lines.append("See a Goon to for help")
-                    pygame.time.set_timer(self.DEBOUNCE, 5000, loops=1)
+                    self.set_screen(self.ERROR, ["Unable to validate order",
+                                                 "Are you being naughty?",
+                                                 "See a Goon to for help"])
                 if event.type == self.ORDERERROR:
-                    self.screen.fill(self.ERROR)
-                    self.text_lines.clear()
-                    self.text_lines.append("Unable to fulfill order")
-                    self.text_lines.append("Item out of stock")
-                    self.text_lines.append("See a Goon for help")
-                    pygame.time.set_timer(self.DEBOUNCE, 5000, loops=1)
+                    self.set_screen(self.ERROR, ["Unable to fulfill order",
+                                                 "Item out of stock",
+                                                 "See a Goon for help"])
                 if event.type == self.INFO:
-                    self.screen.fill(self.PRIMARY)
-                    self.text_lines.clear()
-                    self.text_lines.append(f"Station has processed {odb.get_order_count()} orders")
-                    self.text_lines.append(f"{odb.get_unsynced_order_count()} orders are unsynced")
-                    self.text_lines.append(f"Station id: {os.environ['STATION']}")
-                    self.text_lines.append(f"printer ready: {pm.check_connection()}")
-                    pygame.time.set_timer(self.DEBOUNCE, 5000, loops=1)
+                    self.set_screen(self.PRIMARY, event.lines)
+                if event.type == self.STATUS:
+                    # stays up until the next screen replaces it
+                    pygame.time.set_timer(self.DEBOUNCE, 0)
+                    self.set_screen(self.PRIMARY, event.lines, timeout=None)
+                if event.type == self.BUSY:
+                    self.set_screen(self.ERROR, ["Station is busy",
+                                                 "Please scan again"])
+                if event.type == self.REPRINT:
+                    self.set_screen(self.SUCCESS, [f"Reprinting order {event.txn}",
+                                                   "Please take your receipt"])
+                if event.type == self.DUPLICATE:
+                    if event.txn is None:
+                        self.set_screen(self.ERROR, ["Order already in progress",
+                                                     "Please take your receipt"])
+                    else:
+                        self.set_screen(self.ERROR, [f"Already placed as order {event.txn}",
+                                                     "Please take your receipt",
+                                                     "New order? Scan again in a few seconds"])
+
+            self.draw()
+
+def run_ui_process(conn, info):
+    # entry point of the display process; screen events arrive over the pipe from UIProcess
+    journal.configure(os.environ.get('JOURNAL_LEVELS', 'info'))
+    journal.start()
+    async def run():
+        events = asyncio.Queue()
+        display_ui = None
+        def receive():
+            try:
+                while conn.poll():
+                    events.put_nowait(conn.recv())
+            except (EOFError, OSError):
+                # the station went away, nothing left to show
+                asyncio.get_running_loop().remove_reader(conn.fileno())
+                display_ui.running = False
+        display_ui = DisplayUI(events, info, on_quit=lambda: conn.send("quit"))
+        asyncio.get_running_loop().add_reader(conn.fileno(), receive)
+        await display_ui.run()
+    asyncio.run(run())
+    pygame.quit()
+
+class UIProcess:
+    # runs DisplayUI in a child process so a slow or crashed display never stalls scanning, printing or syncing
+    def __init__(self, events, info=station_info, outbox_size=64, check_interval=1, restart_delay=2):
+        self.events = events
+        self.info = info
+        self.outbox = queue.Queue(maxsize=outbox_size)
+        self.check_interval = check_interval
+        self.restart_delay = restart_delay
+        self.context = multiprocessing.get_context("spawn")
+        self.process = None
+        self.conn = None
+        self.restarts = 0
+        self.dropped = 0
+
+    def start(self):
+        conn, child = self.context.Pipe()
+        self.process = self.context.Process(target=run_ui_process, args=(child, self.info()), name="display-ui", daemon=True)
+        self.process.start()
+        child.close()
+        self.conn = conn
+        loop.add_reader(conn.fileno(), self.receive, conn)
+        journal.info("ui", "process_started", pid=self.process.pid)
+
+    def receive(self, conn):
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            loop.remove_reader(conn.fileno())
+            return
+        if message == "quit":
+            for task in asyncio.all_tasks():
+                task.cancel()
+
+    def sender(self):
+        while True:
+            event = self.outbox.get()
+            try:
+                self.conn.send(event)
+            except (OSError, ValueError) as err:
+                # the supervisor notices the dead process and restarts it
+                journal.warning("ui", "send_failed", error=str(err))
+
+    async def supervise(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            if self.process.is_alive():
+                continue
+            journal.error("ui", "process_exited", exitcode=self.process.exitcode)
+            loop.remove_reader(self.conn.fileno())
+            self.conn.close()
+            self.restarts += 1
+            metrics.inc("ui_restarts_total")
+            await asyncio.sleep(self.restart_delay)
+            self.start()
 
+    async def run(self):
+        self.start()
+        threading.Thread(target=self.sender, name="display-ipc", daemon=True).start()
+        loop.create_task(self.supervise())
+        while True:
+            event = await self.events.get()
+            try:
+                self.outbox.put_nowait(event)
+            except queue.Full:
+                # only the latest screen matters, so a stuck display loses events rather than holding them
+                self.dropped += 1
+                metrics.inc("ui_events_dropped_total")
+
+
+class Startup:
+    # times the startup phases and says on screen which of them are still running
+    STATUS = {"database": "Opening the orders database",
+              "scanners": "Scanner connecting",
+              "printers": "Printer connecting",
+              "printer_connect": "Printer connecting",
+              "inventory": "Loading inventory"}
+
+    def __init__(self, phases):
+        self.began = time.monotonic()
+        self.pending = list(phases)
+        self.phases = {}
+        self.marks = {}
+
+    async def phase(self, name, fn, *args):
+        # blocking work goes to a thread so the phases overlap each other and the UI
+        start = time.monotonic()
+        try:
+            if asyncio.iscoroutinefunction(fn):
+                result = await fn(*args)
+            else:
+                result = await asyncio.to_thread(fn, *args)
+        except Exception as err:
+            journal.error("startup", "phase_failed", phase=name, error=str(err), ms=round((time.monotonic() - start)*1000, 1))
+            raise
+        self.phases[name] = time.monotonic() - start
+        self.pending.remove(name)
+        journal.info("startup", "phase_done", phase=name, ms=round(self.phases[name]*1000, 1), at_ms=self.elapsed())
+        if self.pending:
+            pipeline.publish({"control": "status", "lines": self.info()})
+        return result
+
+    def mark(self, name):
+        self.marks[name] = time.monotonic() - self.began
+        journal.info("startup", name, at_ms=self.elapsed())
+
+    def elapsed(self):
+        return round((time.monotonic() - self.began)*1000, 1)
+
+    def info(self):
+        if not self.pending:
+            return station_info()
+        waiting = list(dict.fromkeys(self.STATUS[name] for name in self.pending))
+        if "capture_ready" in self.marks:
+            return ["Please scan your QR code"] + waiting
+        return ["Station starting up"] + waiting + [f"Station id: {os.environ['STATION']}"]
+
+def open_scanners():
+    import evdev
+    devices = []
+    try:
+        filenames = os.listdir("/dev/input/by-path")
+    except FileNotFoundError:
+        journal.error("scanner", "no_input_devices")
+        return []
+    for filename in filenames:
+        try:
+            devices.append(evdev.InputDevice("/dev/input/by-path/"+filename))
+        except Exception as err:
+            journal.warning("scanner", "open_failed", path=filename, error=str(err))
+    journal.debug("scanner", "devices", devices=[device.name for device in devices])
 
-            pygame.display.update()
-            await asyncio.sleep(0.1)
-            
+    scanners = []
+    for idx, device in enumerate(devices):
+        if device.name in scanner_names:
+            journal.info("scanner", "found", index=idx, path=device.path)
+            device.grab() #grab for exclusive access
+            scanners.append(device)
+    return scanners
+
+def open_printers():
+    return PrintDispatcher([PrintSpooler(PrinterManager(config), maxsize=int(os.environ.get('PRINT_QUEUE_SIZE', 32)))
+                            for config in printer_configs()],
+                           scanner_lanes=scanner_lane_map())
+
+async def connect_printers():
+    # the first health check connects each printer; the spoolers hold their jobs until then
+    await asyncio.gather(*(spooler.pm.health.check() for spooler in dispatcher.spoolers.values()))
+    dispatcher.start()
+
+def start_journal():
+    journal.configure(os.environ.get('JOURNAL_LEVELS', 'info'))
+    journal.start(os.environ.get('JOURNAL_DIR', 'journal'),
+                  echo=os.environ.get('JOURNAL_ECHO', '1').lower() in ("1", "true", "yes"),
+                  max_bytes=int(os.environ.get('JOURNAL_MAX_BYTES', 8*1024*1024)),
+                  backups=int(os.environ.get('JOURNAL_BACKUPS', 20)))
 
 async def main():
     load_dotenv()
+    start_journal()
     global background_tasks
     background_tasks = []
     global loop
     loop = asyncio.get_event_loop()
+    startup = Startup(["database", "scanners", "printers", "inventory", "printer_connect"])
+    metrics.gauge("startup_phase_seconds", lambda: [({"phase": name}, t) for name, t in startup.phases.items()],
+                  "how long each startup phase took")
+    metrics.gauge("startup_seconds", lambda: [({"milestone": name}, t) for name, t in startup.marks.items()],
+                  "seconds from start until the UI and order capture were up")
+
+    global pipeline
+    duplicates = DuplicateDetector(window=int(os.environ.get('DUPLICATE_WINDOW', 5)))
+    pipeline = OrderPipeline(queue_size=int(os.environ.get('PIPELINE_QUEUE_SIZE', 16)), duplicates=duplicates)
+
+    # database and scanner discovery are mostly waiting on the disk and devices, so they run behind
+    # the UI; the printers import escpos and would compete with pygame for the GIL, so they follow it
+    database = loop.create_task(startup.phase("database", OrderDB, os.environ['DB_PATH']))
+    scanners = loop.create_task(startup.phase("scanners", open_scanners))
+    await asyncio.sleep(0)
+    if os.environ.get('UI_PROCESS', '').lower() in ("1", "true", "yes"):
+        background_tasks.append(loop.create_task(UIProcess(pipeline.subscribe(), info=startup.info).run()))
+    else:
+        display_ui = DisplayUI(pipeline.subscribe(), startup.info())
+        background_tasks.append(loop.create_task(display_ui.run()))
+    startup.mark("ui_ready")
+    printers = loop.create_task(startup.phase("printers", open_printers))
 
-
-
-    global pm
-    pm = PrinterManager()
+    global odb
+    odb = await database
 
     global inventory
-    inventory = Inventory()
-
+    hub_url = os.environ.get('HUB_URL', '').rstrip("/")
+    inventory = Inventory(os.environ['INVENTORY_URL'], interval=int(os.environ.get('INVENTORY_INTERVAL', 60)),
+                          hub_url=hub_url and hub_url + "/inventory")
+    await asyncio.gather(startup.phase("inventory", inventory.load_snapshot), duplicates.load())
     loop.create_task(inventory.periodicly_update_inventory())
-
-    global odb
-    odb = OrderDB(os.environ['DB_PATH'])
-    bulk_sync_order()
-    
-    print(f"processed {odb.get_order_count()} orders, {odb.get_unsynced_order_count} are unsynced")
-
-    devices = []
-    for filename in os.listdir("/dev/input/by-path"):
-        try:
-            devices.append(evdev.InputDevice("/dev/input/by-path/"+filename))
-        except Exception as err:
-            print(err)
-    print(devices)
-    
-    for idx, device in enumerate(devices):
-       if device.name in scanner_names:
-           print(f"found scanner at index {idx}, {device.path}")
-           device.grab() #grab for exclusive access
-           task = handle_barcode_scan(device)
-           background_tasks.append(task)
-
-
-    display_ui = DisplayUI()
-    background_tasks.append(display_ui.run())
+    if os.environ.get('STOCK_URL'):
+        loop.create_task(inventory.follow_stock(os.environ['STOCK_URL']))
+
+    global sync_worker
+    sync_worker = SyncWorker(os.environ.get('SYNC_URL', 'https://confmgr3.junctorconf.net/conf/merch_addtxn.php'),
+                             concurrency=int(os.environ.get('SYNC_CONCURRENCY', 4)),
+                             batch_size=int(os.environ.get('SYNC_BATCH_SIZE', 20)),
+                             hub_url=hub_url and hub_url + "/merch_addtxn.php")
+    loop.create_task(sync_worker.run())
+    loop.create_task(odb.periodicly_archive_orders(int(os.environ.get('ORDER_RETENTION_DAYS', 7))))
+
+    # orders can be taken once there is somewhere to store, validate and spool them; printing
+    # starts whenever the printers finish connecting
+    global dispatcher
+    dispatcher = await printers
+    pipeline.start()
+    for device in await scanners:
+        background_tasks.append(loop.create_task(handle_barcode_scan(device)))
+    startup.mark("capture_ready")
+    pipeline.publish({"control": "status", "lines": startup.info()})
+    register_gauges()
+    await metrics.serve(os.environ.get('METRICS_HOST', '127.0.0.1'), int(os.environ.get('METRICS_PORT', 9810)),
+                        routes=[("POST", "/reprint/{txn}", handle_reprint)])
+
+    await startup.phase("printer_connect", connect_printers)
+    pipeline.publish({"control": "info", "lines": station_info()})
+    journal.info("station", "started", orders=odb.get_order_count(), unsynced=odb.get_unsynced_order_count(),
+                 phases_ms={name: round(t*1000, 1) for name, t in startup.phases.items()},
+                 milestones_ms=dict({name: round(t*1000, 1) for name, t in startup.marks.items()}, ready=startup.elapsed()))
 
     await asyncio.gather(*background_tasks)
 
 
+async def hub_main():
+    load_dotenv()
+    start_journal()
+    global loop
+    loop = asyncio.get_running_loop()
+    path = os.environ.get('HUB_DB_PATH', 'hub.db')
+    # the hub keeps its own counters and writer thread, so sharing a station's orders database would corrupt both
+    if 'DB_PATH' in os.environ and os.path.realpath(path) == os.path.realpath(os.environ['DB_PATH']):
+        print("HUB_DB_PATH must not be the station's DB_PATH")
+        exit(-1)
+    db = OrderDB(path)
+    hub = Hub(db, os.environ['INVENTORY_URL'],
+              os.environ.get('SYNC_URL', 'https://confmgr3.junctorconf.net/conf/merch_addtxn.php'),
+              interval=int(os.environ.get('INVENTORY_INTERVAL', 60)),
+              concurrency=int(os.environ.get('SYNC_CONCURRENCY', 4)),
+              batch_size=int(os.environ.get('SYNC_BATCH_SIZE', 20)))
+    metrics.gauge("relay_backlog", lambda: [({}, db.relay_backlog)], "station orders not yet forwarded upstream")
+    metrics.gauge("hub_feed_age_seconds", lambda: [({}, time.time() - hub.updated if hub.updated else None)])
+    await hub.start(os.environ.get('HUB_HOST', '0.0.0.0'), int(os.environ.get('HUB_PORT', 8080)))
+    await asyncio.Event().wait()
+
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="merch scan station")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("run", help="run the station (default)")
+    replay_parser = commands.add_parser("replay", help="show a txn's timeline from the event journal")
+    replay_parser.add_argument("txn")
+    replay_parser.add_argument("--dir", default=os.environ.get('JOURNAL_DIR', 'journal'))
+    reprint_parser = commands.add_parser("reprint", help="reprint a receipt on the running station (staff only)")
+    reprint_parser.add_argument("txn")
+    export_parser = commands.add_parser("export", help="stream orders, per-variant totals or unsynced txns from the orders database")
+    export_parser.add_argument("what", choices=EXPORTS)
+    export_parser.add_argument("--db", help="orders database, defaults to DB_PATH")
+    export_parser.add_argument("--format", choices=("csv", "jsonl"), default="csv")
+    export_parser.add_argument("--out", default="-", help="output file, - for stdout")
+    export_parser.add_argument("--since", help="ISO time, inclusive; local time unless an offset is given")
+    export_parser.add_argument("--until", help="ISO time, exclusive")
+    synced = export_parser.add_mutually_exclusive_group()
+    synced.add_argument("--synced", dest="synced", action="store_const", const=True)
+    synced.add_argument("--unsynced", dest="synced", action="store_const", const=False)
+    export_parser.add_argument("--upstream", help="for missing: file of txns known upstream, one per line, - for stdin")
+    commands.add_parser("hub", help="run as the booth hub that relays inventory and orders for the stations")
+    args = parser.parse_args()
+    if args.command == "replay":
+        replay(args)
+    elif args.command == "reprint":
+        request_reprint(args)
+    elif args.command == "export":
+        export(args)
+    elif args.command == "hub":
+        asyncio.run(hub_main())
+    else:
+        asyncio.run(main())
\ No newline at end of file